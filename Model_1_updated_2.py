@@ -1,22 +1,58 @@
 import random
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
+from PIL import Image, ImageDraw, ImageFont, ImageColor
+import numpy as np
+import math
+import time
 from textwrap import wrap
-from colorthief import ColorThief
 import io
 import boto3
+from botocore.config import Config
 from botocore.exceptions import NoCredentialsError
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import copy
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
+from functools import lru_cache
+from contextlib import closing
 
 # Set up your AWS credentials
 os.environ['AWS_ACCESS_KEY_ID'] = ''
 os.environ['AWS_SECRET_ACCESS_KEY'] = ''
 os.environ['AWS_DEFAULT_REGION'] = ''
 
+FONT_PATH_HEADING = "services/Fonts/ARIALBD.TTF"
+FONT_PATH_DESC = "services/Fonts/arial.ttf"
+FONT_PATH_CTA = "services/Fonts/ARIALBD.TTF"
+FONT_PATH_CONTACT = "services/Fonts/arial.ttf"
+
+# Upper bound on cached (path, size) faces; least recently used sizes are evicted first
+FONT_CACHE_SIZE = 256
+
 def get_font_name(font_path):
     return os.path.basename(font_path)
 
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def get_font(font_path, font_size):
+    # Faces are shared across requests and threads. Loading by path lets
+    # FreeType read the file on demand; a face loaded from a bytes buffer would
+    # hold its own copy of the whole font file.
+    return ImageFont.truetype(font_path, font_size)
+
+def preload_fonts(font_sizes=(40, 50)):
+    # Pay the font loading cost at startup instead of on the first request
+    for font_path in {FONT_PATH_HEADING, FONT_PATH_DESC, FONT_PATH_CTA, FONT_PATH_CONTACT}:
+        for font_size in font_sizes:
+            get_font(font_path, font_size)
+
 # Define the post_and_fetch_layouts function
 def post_and_fetch_layouts(layouts_info):
     url = 'http://dev.api.sparkiq.ai/image-generations'
@@ -34,606 +70,1374 @@ def post_and_fetch_layouts(layouts_info):
         except requests.exceptions.RequestException as e:
             print('Error:', e)
 
-# Define the generate_ad_template function
-def generate_ad_template(heading, desc, cta, contact, logo_bytes, product_bytes):
-    # Convert bytes to file-like objects
-    logo_file = io.BytesIO(logo_bytes)
-    product_file = io.BytesIO(product_bytes)
-
-    # Load the images
-    logo_image = Image.open(logo_file).convert("RGBA")
-    product_image = Image.open(product_file).convert("RGBA")
-
-    # S3 client
-    s3_client = boto3.client('s3')
-    bucket_name = "sparkiq-image-upload"
-
-    def upload_to_s3(file_bytes, file_name):
-        with io.BytesIO(file_bytes) as file:
-            try:
-                s3_client.upload_fileobj(file, bucket_name, file_name, ExtraArgs={'ACL': 'public-read'})
-                return f"https://{bucket_name}.s3.amazonaws.com/{file_name}"
-            except NoCredentialsError:
-                print("Credentials not available for S3 upload.")
-                return None
-
-    logo_url = upload_to_s3(logo_bytes, "logo.png")
-    product_url = upload_to_s3(product_bytes, "product.png")
-
-    def limit_title_to_four_words(title):
-        words = title.split()
-        return ' '.join(words[:4])
-
-    def format_title(title, max_length=25):
-        title = limit_title_to_four_words(title)
-        words = title.split()
-        if len(title) > max_length:
-            midpoint = len(words) // 2
-            line1 = ' '.join(words[:midpoint])
-            line2 = ' '.join(words[midpoint:])
-            return f"{line1}\n{line2}"
-        return title
-
-    def get_dominant_color(image):
-        with io.BytesIO() as output:
-            image.save(output, format="PNG")
-            output.seek(0)
-            color_thief = ColorThief(output)
-            dominant_color = color_thief.get_color(quality=1)
-            return '#{:02x}{:02x}{:02x}'.format(dominant_color[0], dominant_color[1], dominant_color[2])
+GRADIENT_DIRECTIONS = ['left_to_right', 'top_to_bottom', 'right_to_left', 'bottom_to_top', 'diagonal_tl_br', 'diagonal_bl_tr']
+
+def _gradient_ramp(width, height, direction):
+    # Float ramp in [0, 255] built from 1-D axes and broadcast to (height, width).
+    # The named directions use the same arithmetic as the old per-pixel list
+    # comprehensions, so truncating the ramp gives an identical mask.
+    xs = np.arange(width, dtype=np.float64)
+    ys = np.arange(height, dtype=np.float64)
+
+    if direction == 'left_to_right':
+        return np.broadcast_to(255 * (xs / width), (height, width))
+    elif direction == 'top_to_bottom':
+        return np.broadcast_to((255 * (ys / height))[:, None], (height, width))
+    elif direction == 'right_to_left':
+        return np.broadcast_to(255 * ((width - xs) / width), (height, width))
+    elif direction == 'bottom_to_top':
+        return np.broadcast_to((255 * ((height - ys) / height))[:, None], (height, width))
+    elif direction == 'diagonal_tl_br':
+        return 255 * (np.add.outer(ys, xs) / (width + height))
+    elif direction == 'diagonal_bl_tr':
+        return 255 * (np.add.outer(height - ys, xs) / (width + height))
+    elif isinstance(direction, (int, float)):
+        # Arbitrary angle in degrees: 0 runs left to right, 90 top to bottom.
+        theta = math.radians(direction)
+        projection = np.add.outer(ys * math.sin(theta), xs * math.cos(theta))
+        low, high = projection.min(), projection.max()
+        if high == low:
+            return np.zeros((height, width))
+        return 255 * ((projection - low) / (high - low))
+
+    raise ValueError(f"Unknown gradient direction: {direction}")
+
+def gradient_mask(width, height, direction='left_to_right'):
+    return Image.fromarray(_gradient_ramp(width, height, direction).astype(np.uint8))
+
+def generate_gradient_color(color1, color2, width, height, direction='left_to_right'):
+    base = Image.new('RGB', (width, height), color1)
+    top = Image.new('RGB', (width, height), color2)
+
+    # The ramp is already smooth, so no ImageFilter.SMOOTH pass is needed afterwards
+    return Image.composite(top, base, gradient_mask(width, height, direction))
+
+def generate_multi_stop_gradient(colors, width, height, direction='left_to_right', stops=None):
+    # colors: hex strings or RGB tuples; stops: positions in [0, 1], evenly spaced by default
+    rgb_stops = np.array([ImageColor.getrgb(c)[:3] if isinstance(c, str) else tuple(c)[:3] for c in colors], dtype=np.float64)
+    if stops is None:
+        stops = np.linspace(0.0, 1.0, len(colors))
+
+    # Interpolate once per mask level and look the 256-entry table up for every pixel
+    levels = np.arange(256) / 255.0
+    lut = np.stack([np.interp(levels, stops, rgb_stops[:, c]) for c in range(3)], axis=1)
+    lut = np.rint(lut).astype(np.uint8)
+
+    mask = _gradient_ramp(width, height, direction).astype(np.uint8)
+    return Image.fromarray(lut[mask])
+
+def adjust_font_size_based_on_space(draw, text, font_path, max_width, max_height, max_font_size=100, additional_size=0, min_font_size=28):
+    low = min_font_size + additional_size
+    high = max_font_size + additional_size
+    measured = {}
+
+    def measure(font_size):
+        if font_size not in measured:
+            text_bbox = draw.textbbox((0, 0), text, font=get_font(font_path, font_size))
+            measured[font_size] = (text_bbox[2] - text_bbox[0], text_bbox[3] - text_bbox[1])
+        return measured[font_size]
+
+    def fits(font_size):
+        text_width, text_height = measure(font_size)
+        return text_width <= max_width and text_height <= max_height
+
+    if not fits(low):
+        # Nothing fits; same answer the old linear scan from min_font_size gave
+        font_size = low - 1 if low > min_font_size else low
+        return get_font(font_path, font_size), font_size
+
+    # Text extents grow roughly linearly with the font size, so scale the first
+    # measurement to estimate the answer, then bisect around the estimate.
+    # Invariant: `good` fits, `bad` does not (or is past the maximum size).
+    text_width, text_height = measure(low)
+    scale = min(max_width / text_width if text_width else float('inf'),
+                max_height / text_height if text_height else float('inf'))
+    guess = max(low, min(high, int(low * scale)))
+    good, bad = low, high + 1
+
+    for probe in (guess, guess + 1):
+        if good < probe < bad:
+            if fits(probe):
+                good = probe
+            else:
+                bad = probe
 
-    def get_palette(image, color_count=6):
-        with io.BytesIO() as output:
-            image.save(output, format="PNG")
-            output.seek(0)
-            color_thief = ColorThief(output)
-            palette = color_thief.get_palette(color_count=color_count)
-            return ['#{:02x}{:02x}{:02x}'.format(color[0], color[1], color[2]) for color in palette]
-
-    def get_contrasting_text_color(background_color):
-        def hex_to_rgb(hex_color):
-            hex_color = hex_color.lstrip('#')
-            return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
-
-        def rgb_to_brightness(rgb_color):
-            return (rgb_color[0] * 299 + rgb_color[1] * 587 + rgb_color[2] * 114) / 1000
-
-        if isinstance(background_color, str):
-            background_rgb = hex_to_rgb(background_color)
+    while bad - good > 1:
+        middle = (good + bad) // 2
+        if fits(middle):
+            good = middle
         else:
-            background_rgb = background_color
-
-        background_brightness = rgb_to_brightness(background_rgb)
-
-        text_colors = [
-            (0, 0, 0), (255, 255, 255), (255, 69, 0), (255, 140, 0), (255, 215, 0),
-            (0, 128, 128), (0, 0, 255), (75, 0, 130), (238, 130, 238), (0, 128, 0),
-            (128, 0, 0), (0, 0, 128), (128, 0, 128), (0, 128, 0), (0, 255, 255),
-            (255, 20, 147), (255, 105, 180), (60, 179, 113), (255, 69, 0), (255, 255, 0),
-            (0, 255, 0), (0, 100, 0), (139, 69, 19), (210, 105, 30), (255, 165, 0),
-            (75, 0, 130), (123, 104, 238), (106, 90, 205), (153, 50, 204), (148, 0, 211),
-            (75, 0, 130), (143, 188, 143), (127, 255, 0), (255, 99, 71), (64, 224, 208),
-            (0, 191, 255), (25, 25, 112), (47, 79, 79), (105, 105, 105), (112, 128, 144),
-            (220, 20, 60)
-        ]
-
-        contrasting_colors = [color for color in text_colors if abs(rgb_to_brightness(color) - background_brightness) > 125]
-
-        return random.choice(contrasting_colors)
-
-    def get_random_contrasting_color(exclude_colors=None):
-        exclude_colors = exclude_colors or []
-        colors = [
-            (0, 0, 0), (255, 255, 255), (255, 69, 0), (255, 140, 0), (255, 215, 0),
-            (0, 128, 128), (0, 0, 255), (75, 0, 130), (238, 130, 238), (0, 128, 0),
-            (128, 0, 0), (0, 0, 128), (128, 0, 128), (0, 128, 0), (0, 255, 255),
-            (255, 20, 147), (255, 105, 180), (60, 179, 113), (255, 69, 0), (255, 255, 0),
-            (0, 255, 0), (0, 100, 0), (139, 69, 19), (210, 105, 30), (255, 165, 0),
-            (75, 0, 130), (123, 104, 238), (106, 90, 205), (153, 50, 204), (148, 0, 211),
-            (75, 0, 130), (143, 188, 143), (127, 255, 0), (255, 99, 71), (64, 224, 208),
-            (0, 191, 255), (25, 25, 112), (47, 79, 79), (105, 105, 105), (112, 128, 144),
-            (220, 20, 60)
-        ]
-        colors = [color for color in colors if color not in exclude_colors]
-        return random.choice(colors)
-
-    def generate_gradient_color(color1, color2, width, height, direction='left_to_right'):
-        base = Image.new('RGB', (width, height), color1)
-        mask = Image.new('L', (width, height))
-        top = Image.new('RGB', (width, height), color2)
-
-        mask_data = []
-
-        if direction == 'left_to_right':
-            mask_data = [int(255 * (x / width)) for y in range(height) for x in range(width)]
-        elif direction == 'top_to_bottom':
-            mask_data = [int(255 * (y / height)) for y in range(height) for x in range(width)]
-        elif direction == 'right_to_left':
-            mask_data = [int(255 * ((width - x) / width)) for y in range(height) for x in range(width)]
-        elif direction == 'bottom_to_top':
-            mask_data = [int(255 * ((height - y) / height)) for y in range(height) for x in range(width)]
-        elif direction == 'diagonal_tl_br':
-            mask_data = [int(255 * ((x + y) / (width + height))) for y in range(height) for x in range(width)]
-        elif direction == 'diagonal_bl_tr':
-            mask_data = [int(255 * ((x + (height - y)) / (width + height))) for y in range(height) for x in range(width)]
-
-        mask.putdata(mask_data)
-        base.paste(top, (0, 0), mask)
-
-        return base.filter(ImageFilter.SMOOTH)
-
-    def get_complementary_color(color):
-        return (255 - color[0], 255 - color[1], 255 - color[2])
-
-    def sample_background_color(image, positions, area_size=10):
-        colors = []
-        for pos in positions:
-            x, y = pos
-            for i in range(-area_size // 2, area_size // 2):
-                for j in range(-area_size // 2, area_size // 2):
-                    try:
-                        colors.append(image.getpixel((x + i, y + j)))
-                    except IndexError:
-                        continue
-        avg_color = tuple(sum(c) // len(c) for c in zip(*colors))
-        return avg_color
-
-    def wrap_text(text, max_width, draw, font):
-        lines = []
-        for line in text.split('\n'):
-            lines.extend(wrap(line, width=max_width, break_long_words=False))
-        return lines
-
-    def is_overlap(box1, box2):
-        return not (box1[2] < box2[0] or box1[0] > box2[2] or box1[3] < box2[1] or box1[1] > box2[3])
-
-    def adjust_font_size_based_on_space(draw, text, font_path, max_width, max_height, max_font_size=100, additional_size=0):
-        min_font_size = 28
-        font_size = min_font_size + additional_size
-
-        while font_size <= max_font_size + additional_size:
-            font = ImageFont.truetype(font_path, font_size)
-            text_bbox = draw.textbbox((0, 0), text, font=font)
-            text_width, text_height = text_bbox[2] - text_bbox[0], text_bbox[3] - text_bbox[1]
-            if text_width <= max_width and text_height <= max_height:
-                font_size += 1
-            else:
-                break
+            bad = middle
+
+    return get_font(font_path, good), good
+
+class LRUCache:
+    # Small thread-safe mapping that evicts the least recently used entries once
+    # it holds more than max_entries items or, given sizeof, more than max_bytes
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        nbytes = self.sizeof(value) if self.sizeof else 0
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.total_bytes += nbytes
+            while self._entries and ((self.max_entries is not None and len(self._entries) > self.max_entries)
+                                     or (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+                self.total_bytes -= self._entries.popitem(last=False)[1][1]
+
+    def __len__(self):
+        return len(self._entries)
+
+# Pixel budget for palette extraction; larger images are subsampled down to it
+PALETTE_MAX_PIXELS = 50000
+
+def _median_cut(colors, counts, color_count):
+    # colors: distinct 5-bit quantized colors (n, 3), counts: pixels per color.
+    # Boxes are index arrays into colors. Like ColorThief's MMCQ, the first 75%
+    # of the boxes are split by population and the rest by population * volume.
+    boxes = [np.arange(len(colors))]
+
+    def score(box, by_volume):
+        if len(box) < 2:
+            return -1
+        population = int(counts[box].sum())
+        if not by_volume:
+            return population
+        box_colors = colors[box]
+        return population * int(np.prod(box_colors.max(axis=0) - box_colors.min(axis=0) + 1))
+
+    while len(boxes) < color_count:
+        by_volume = len(boxes) >= 0.75 * color_count
+        scores = [score(box, by_volume) for box in boxes]
+        target = int(np.argmax(scores))
+        if scores[target] < 0:
+            break  # every box holds a single color
+
+        box = boxes.pop(target)
+        box_colors = colors[box]
+        axis = int(np.argmax(box_colors.max(axis=0) - box_colors.min(axis=0)))
+        box = box[np.argsort(box_colors[:, axis], kind='stable')]
+
+        # Split at the population median along the longest axis
+        cumulative = np.cumsum(counts[box])
+        split = int(np.searchsorted(cumulative, cumulative[-1] / 2)) + 1
+        split = min(max(split, 1), len(box) - 1)
+        boxes += [box[:split], box[split:]]
+
+    return boxes
+
+def extract_palette(image, color_count=6, max_pixels=PALETTE_MAX_PIXELS):
+    # Median-cut palette computed directly on the decoded pixels, ordered by
+    # population so the first entry is the dominant color
+    start = time.perf_counter()
+
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    pixels = np.asarray(image).reshape(-1, 4)
+    if len(pixels) > max_pixels:
+        pixels = pixels[::-(-len(pixels) // max_pixels)]
+
+    # Same pixel filter as ColorThief: skip transparent and near-white pixels
+    valid = (pixels[:, 3] >= 125) & ~np.all(pixels[:, :3] > 250, axis=1)
+    quantized = pixels[valid, :3] >> 3
+    if len(quantized) == 0:
+        raise ValueError("Image has no opaque, non-white pixels to extract a palette from")
+
+    histogram = np.bincount((quantized[:, 0].astype(np.int32) << 10) | (quantized[:, 1].astype(np.int32) << 5) | quantized[:, 2], minlength=1 << 15)
+    indices = np.flatnonzero(histogram)
+    counts = histogram[indices]
+    colors = np.stack([indices >> 10, (indices >> 5) & 31, indices & 31], axis=1)
+
+    boxes = _median_cut(colors, counts, color_count)
+    boxes.sort(key=lambda box: int(counts[box].sum()), reverse=True)
+
+    palette = []
+    for box in boxes:
+        weights = counts[box]
+        average = ((colors[box] + 0.5) * 8 * weights[:, None]).sum(axis=0) / weights.sum()
+        r, g, b = (min(int(c), 255) for c in average)
+        palette.append('#{:02x}{:02x}{:02x}'.format(r, g, b))
+
+    print(f"Palette of {len(palette)} colors from {int(valid.sum())} pixels in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return palette
+
+def get_palette(image, color_count=6):
+    return extract_palette(image, color_count=color_count)
+
+def get_dominant_color(image):
+    return extract_palette(image, color_count=5)[0]
+
+def get_analogous_colors(color):
+    r, g, b = color
+    analogous_1 = ((r + 30) % 256, (g + 30) % 256, (b + 30) % 256)
+    analogous_2 = ((r - 30) % 256, (g - 30) % 256, (b - 30) % 256)
+    return [analogous_1, analogous_2]
+
+def filter_analogous_colors(color, palette):
+    def is_same_color_family(color1, color2):
+        return abs(color1[0] - color2[0]) <= 30 and abs(color1[1] - color2[1]) <= 30 and abs(color1[2] - color2[2]) <= 30
+
+    filtered_colors = []
+    for c in palette:
+        if is_same_color_family(color, c):
+            filtered_colors.append(c)
+
+    return filtered_colors
+
+# Brand logos are reused across many requests, so their colors are cached by content hash
+LOGO_COLORS_CACHE_SIZE = 1024
+logo_colors_cache = LRUCache(LOGO_COLORS_CACHE_SIZE)
+
+def get_logo_colors(logo_image, logo_digest, color_count=6):
+    # Returns the logo palette plus the hex candidates (palette and analogous
+    # colors) that layouts pick their gradient colors from
+    key = (logo_digest, color_count)
+    cached = logo_colors_cache.get(key)
+    if cached is not None:
+        return cached
+
+    palette = get_palette(logo_image, color_count=color_count)
+
+    all_colors = []
+    for color in palette:
+        rgb_color = tuple(int(color[i:i+2], 16) for i in (1, 3, 5))
+        analogous_colors = get_analogous_colors(rgb_color)
+        all_colors.append(rgb_color)
+        all_colors.extend(filter_analogous_colors(rgb_color, analogous_colors))
+
+    unique_colors = list(set(all_colors))
+    hex_colors = tuple('#{:02x}{:02x}{:02x}'.format(r, g, b) for r, g, b in unique_colors)
+
+    logo_colors = (tuple(palette), hex_colors)
+    logo_colors_cache.put(key, logo_colors)
+    return logo_colors
+
+def limit_title_to_four_words(title):
+    words = title.split()
+    return ' '.join(words[:4])
+
+def format_title(title, max_length=25):
+    title = limit_title_to_four_words(title)
+    words = title.split()
+    if len(title) > max_length:
+        midpoint = len(words) // 2
+        line1 = ' '.join(words[:midpoint])
+        line2 = ' '.join(words[midpoint:])
+        return f"{line1}\n{line2}"
+    return title
+
+def get_contrasting_text_color(background_color, rng=random):
+    def hex_to_rgb(hex_color):
+        hex_color = hex_color.lstrip('#')
+        return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+
+    def rgb_to_brightness(rgb_color):
+        return (rgb_color[0] * 299 + rgb_color[1] * 587 + rgb_color[2] * 114) / 1000
+
+    if isinstance(background_color, str):
+        background_rgb = hex_to_rgb(background_color)
+    else:
+        background_rgb = background_color
+
+    background_brightness = rgb_to_brightness(background_rgb)
+
+    text_colors = [
+        (0, 0, 0), (255, 255, 255), (255, 69, 0), (255, 140, 0), (255, 215, 0),
+        (0, 128, 128), (0, 0, 255), (75, 0, 130), (238, 130, 238), (0, 128, 0),
+        (128, 0, 0), (0, 0, 128), (128, 0, 128), (0, 128, 0), (0, 255, 255),
+        (255, 20, 147), (255, 105, 180), (60, 179, 113), (255, 69, 0), (255, 255, 0),
+        (0, 255, 0), (0, 100, 0), (139, 69, 19), (210, 105, 30), (255, 165, 0),
+        (75, 0, 130), (123, 104, 238), (106, 90, 205), (153, 50, 204), (148, 0, 211),
+        (75, 0, 130), (143, 188, 143), (127, 255, 0), (255, 99, 71), (64, 224, 208),
+        (0, 191, 255), (25, 25, 112), (47, 79, 79), (105, 105, 105), (112, 128, 144),
+        (220, 20, 60)
+    ]
 
-        return ImageFont.truetype(font_path, font_size - 1 if font_size > min_font_size else font_size), font_size - 1 if font_size > min_font_size else font_size
-
-    def draw_element(draw, key, position, size, text=None, font=None, element_type="text", image_obj=None, cta_shape="rectangle", text_color=(0, 0, 0), background_color=(255, 255, 255), mobile_icon=None):
-        x = int(position[0] * width)
-        y = int(position[1] * height)
-        drawn_elements_info = {}
-
-        if element_type == "text":
-            max_width = int(size[0] * width) if size else width
-            wrapped_text = wrap_text(text, 32, draw, font)
-            max_line_width = max(draw.textbbox((0, 0), line, font=font)[2] for line in wrapped_text)
-            line_height = font.getbbox('A')[3]
-            gap = int(line_height * 0.4)
-            total_height = (line_height + gap) * len(wrapped_text) - gap
-
-            if key == "cta":
-                padding = 30  # Increased padding
-                high_res_width = max_line_width + padding * 2
-                high_res_height = total_height + padding * 2
-
-                # Increase resolution by 8x for anti-aliasing
-                high_res_button = Image.new('RGBA', (high_res_width * 8, high_res_height * 8), (0, 0, 0, 0))
-                high_res_draw = ImageDraw.Draw(high_res_button)
-
-                if cta_shape == "rounded":
-                    radius = 15 * 8
-                    high_res_draw.rounded_rectangle(
-                        [(0, 0), (high_res_width * 8, high_res_height * 8)],
-                        radius=radius,
-                        fill=background_color
-                    )
-                else:
-                    high_res_draw.rectangle(
-                        [(0, 0), (high_res_width * 8, high_res_height * 8)],
-                        fill=background_color
-                    )
-
-                # Smooth the edges of the CTA button by downscaling
-                high_res_button = high_res_button.resize((high_res_width, high_res_height), Image.LANCZOS)
-
-                image.paste(high_res_button, (x - padding, y - padding), high_res_button)
-                drawn_elements_info["cta_button"] = {"size": (high_res_width, high_res_height), "coordinates": (x, y), "color": background_color}
-
-            if key == "desc_first_word":
-                remaining_text = text.strip()
-
-                wrapped_text = wrap_text(remaining_text, 30, draw, font)
-                desc_y = y
-                for i, line in enumerate(wrapped_text):
-                    text_x = x - 20  # Shift the text a bit to the left
-                    text_y = desc_y + i * (line_height + gap)
-                    draw.text((text_x, text_y), line, text_color, font)
-                drawn_elements_info[key] = {"size": (max_line_width, text_y + line_height - y), "coordinates": (x, y), "font_size": font.size}
-
-                return (x, y, x + max_line_width, text_y + line_height), drawn_elements_info
-
-            elif key == "contact":
-                icon_size = int(line_height * 1.5)  # Adjust the size of the mobile icon
-                if mobile_icon is not None:
-                    mobile_icon_resized = mobile_icon.resize((icon_size, icon_size), Image.LANCZOS)
-                    image.paste(mobile_icon_resized, (x, y), mobile_icon_resized)
-                    x += icon_size + 5  # Add some padding after the icon
-
-                for i, line in enumerate(wrapped_text):
-                    text_x = x
-                    text_y = y + i * (line_height + gap)
-                    draw.text((text_x, text_y), line, fill=text_color, font=font)  # Change contact text color to highlight color
-                drawn_elements_info[key] = {"size": (max_line_width, text_y + line_height - y), "coordinates": (x, y), "font_size": font.size}
-
-                return (x - icon_size - 5, y, x + max_line_width, y + total_height), drawn_elements_info
+    contrasting_colors = [color for color in text_colors if abs(rgb_to_brightness(color) - background_brightness) > 125]
+
+    return rng.choice(contrasting_colors)
+
+def get_random_contrasting_color(exclude_colors=None, rng=random):
+    exclude_colors = exclude_colors or []
+    colors = [
+        (0, 0, 0), (255, 255, 255), (255, 69, 0), (255, 140, 0), (255, 215, 0),
+        (0, 128, 128), (0, 0, 255), (75, 0, 130), (238, 130, 238), (0, 128, 0),
+        (128, 0, 0), (0, 0, 128), (128, 0, 128), (0, 128, 0), (0, 255, 255),
+        (255, 20, 147), (255, 105, 180), (60, 179, 113), (255, 69, 0), (255, 255, 0),
+        (0, 255, 0), (0, 100, 0), (139, 69, 19), (210, 105, 30), (255, 165, 0),
+        (75, 0, 130), (123, 104, 238), (106, 90, 205), (153, 50, 204), (148, 0, 211),
+        (75, 0, 130), (143, 188, 143), (127, 255, 0), (255, 99, 71), (64, 224, 208),
+        (0, 191, 255), (25, 25, 112), (47, 79, 79), (105, 105, 105), (112, 128, 144),
+        (220, 20, 60)
+    ]
+    colors = [color for color in colors if color not in exclude_colors]
+    return rng.choice(colors)
+
+def get_complementary_color(color):
+    return (255 - color[0], 255 - color[1], 255 - color[2])
+
+def region_sum(image, region):
+    # Per-band pixel sum and pixel count of an (x1, y1, x2, y2) region, clamped
+    # to the image. Only the region is copied out, so its size costs no Python work.
+    x1, y1, x2, y2 = region
+    box = (max(int(x1), 0), max(int(y1), 0), min(int(x2), image.width), min(int(y2), image.height))
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return np.zeros(len(image.getbands()), dtype=np.int64), 0
+    pixels = np.asarray(image.crop(box)).reshape(-1, len(image.getbands()))
+    return pixels.sum(axis=0, dtype=np.int64), len(pixels)
+
+def sample_region_colors(image, regions):
+    # Mean colour of each region, or None for a region entirely off the image
+    colors = []
+    for region in regions:
+        total, count = region_sum(image, region)
+        colors.append(tuple(int(c) for c in total // count) if count else None)
+    return colors
+
+def sample_background_color(image, positions, area_size=10):
+    # Mean colour of the area_size squares around the positions, taken together
+    low, high = -area_size // 2, area_size // 2
+    total, count = 0, 0
+    for x, y in positions:
+        region_total, region_count = region_sum(image, (x + low, y + low, x + high, y + high))
+        total, count = total + region_total, count + region_count
+    return tuple(int(c) for c in total // count)
+
+def wrap_text(text, max_width, draw, font):
+    lines = []
+    for line in text.split('\n'):
+        lines.extend(wrap(line, width=max_width, break_long_words=False))
+    return lines
+
+def is_overlap(box1, box2):
+    return not (box1[2] < box2[0] or box1[0] > box2[2] or box1[3] < box2[1] or box1[1] > box2[3])
+
+# Every layout of a request measures the same lines in the same few faces (from
+# get_font, so one object per file and size), and hinted small sizes are slow
+# to measure, so widths are kept per (face, line)
+TEXT_MEASURE_CACHE_SIZE = 4096
+
+@lru_cache(maxsize=TEXT_MEASURE_CACHE_SIZE)
+def text_line_width(font, line):
+    return font.getbbox(line)[2]
+
+@lru_cache(maxsize=TEXT_MEASURE_CACHE_SIZE)
+def font_line_height(font):
+    return font.getbbox('A')[3]
+
+# Rendered lines are kept as masks for the same reason; below about 18 px the
+# fonts' hinting makes rendering several times slower, which previews hit on
+# every line. Masks are larger than widths, so fewer are kept.
+TEXT_MASK_CACHE_SIZE = 256
+
+@lru_cache(maxsize=TEXT_MASK_CACHE_SIZE)
+def render_text_line(font, line):
+    # Returns the line's coverage mask and where its origin sits in the mask
+    left, top, right, bottom = font.getbbox(line)
+    origin = (-min(left, 0), -min(top, 0))
+    mask = Image.new('L', (right + origin[0], bottom + origin[1]), 0)
+    ImageDraw.Draw(mask).text(origin, line, 255, font)
+    return mask, origin
+
+def draw_text_line(draw, position, line, fill, font):
+    # Same pixels as draw.text(position, line, fill, font)
+    mask, origin = render_text_line(font, line)
+    draw.bitmap((position[0] - origin[0], position[1] - origin[1]), mask, fill)
+
+def measure_text_block(text, draw, font):
+    # Line layout shared by draw_element and text_element_extent
+    wrapped_text = wrap_text(text, 32, draw, font)
+    max_line_width = max(text_line_width(font, line) for line in wrapped_text)
+    line_height = font_line_height(font)
+    gap = int(line_height * 0.4)
+    total_height = (line_height + gap) * len(wrapped_text) - gap
+    return wrapped_text, max_line_width, line_height, gap, total_height
+
+def text_element_extent(key, text, draw, font, mobile_icon=None, scale=1.0):
+    # The area draw_element will cover for a text element, relative to its position
+    _, max_line_width, line_height, _, total_height = measure_text_block(text, draw, font)
+    if key == "cta":
+        padding = round(30 * scale)
+        return (-padding, -padding, max_line_width + padding, total_height + padding)
+    if key == "desc_first_word":
+        return (-round(20 * scale), 0, max_line_width, total_height)
+    if key == "contact" and mobile_icon is not None:
+        icon_size = int(line_height * 1.5)
+        return (0, 0, icon_size + round(5 * scale) + max_line_width, max(total_height, icon_size))
+    return (0, 0, max_line_width, total_height)
+
+# CTA buttons are anti-aliased analytically at their final size: each pixel's
+# alpha is its coverage, from the signed distance of the pixel centre to the
+# rounded rectangle. Only a few button sizes occur, so shapes are cached.
+CTA_CORNER_RADIUS = 15
+CTA_CACHE_SIZE = 256
+
+@lru_cache(maxsize=CTA_CACHE_SIZE)
+def rounded_rectangle_mask(size, radius):
+    width, height = size
+    half_width, half_height = width / 2, height / 2
+    radius = min(radius, half_width, half_height)
+    qx = np.abs(np.arange(width) + 0.5 - half_width) - (half_width - radius)
+    qy = np.abs(np.arange(height) + 0.5 - half_height) - (half_height - radius)
+    qx, qy = np.meshgrid(qx, qy)
+    distance = np.hypot(np.maximum(qx, 0), np.maximum(qy, 0)) + np.minimum(np.maximum(qx, qy), 0) - radius
+    coverage = np.clip(0.5 - distance, 0, 1)
+    return Image.fromarray(np.round(coverage * 255).astype(np.uint8), 'L')
+
+@lru_cache(maxsize=CTA_CACHE_SIZE)
+def get_cta_button(size, radius, color):
+    # Shared between layouts and requests; callers only read it
+    button = Image.new('RGBA', size, color)
+    button.putalpha(rounded_rectangle_mask(size, radius))
+    return button
+
+def draw_element(image, draw, key, position, size, text=None, font=None, element_type="text", image_obj=None, cta_shape="rectangle", text_color=(0, 0, 0), background_color=(255, 255, 255), mobile_icon=None, scale=1.0):
+    # scale shrinks the fixed pixel paddings and radii for preview renders
+    width, height = image.size
+    x = int(position[0] * width)
+    y = int(position[1] * height)
+    drawn_elements_info = {}
+
+    if element_type == "text":
+        max_width = int(size[0] * width) if size else width
+        wrapped_text, max_line_width, line_height, gap, total_height = measure_text_block(text, draw, font)
+
+        if key == "cta":
+            padding = round(30 * scale)  # Increased padding
+            button_width = max_line_width + padding * 2
+            button_height = total_height + padding * 2
+
+            radius = round(CTA_CORNER_RADIUS * scale) if cta_shape == "rounded" else 0
+            button = get_cta_button((button_width, button_height), radius, tuple(background_color))
+
+            image.paste(button, (x - padding, y - padding), button)
+            drawn_elements_info["cta_button"] = {"size": (button_width, button_height), "coordinates": (x, y), "color": background_color}
+
+        if key == "desc_first_word":
+            remaining_text = text.strip()
+
+            wrapped_text = wrap_text(remaining_text, 30, draw, font)
+            desc_y = y
+            for i, line in enumerate(wrapped_text):
+                text_x = x - round(20 * scale)  # Shift the text a bit to the left
+                text_y = desc_y + i * (line_height + gap)
+                draw_text_line(draw, (text_x, text_y), line, text_color, font)
+            drawn_elements_info[key] = {"size": (max_line_width, text_y + line_height - y), "coordinates": (x, y), "font_size": font.size}
+
+            return (x, y, x + max_line_width, text_y + line_height), drawn_elements_info
+
+        elif key == "contact":
+            icon_size = int(line_height * 1.5)  # Adjust the size of the mobile icon
+            icon_gap = round(5 * scale)
+            if mobile_icon is not None:
+                mobile_icon_resized = mobile_icon.resize((icon_size, icon_size), Image.LANCZOS)
+                image.paste(mobile_icon_resized, (x, y), mobile_icon_resized)
+                x += icon_size + icon_gap  # Add some padding after the icon
+
+            for i, line in enumerate(wrapped_text):
+                text_x = x
+                text_y = y + i * (line_height + gap)
+                draw_text_line(draw, (text_x, text_y), line, text_color, font)  # Change contact text color to highlight color
+            drawn_elements_info[key] = {"size": (max_line_width, text_y + line_height - y), "coordinates": (x, y), "font_size": font.size}
+
+            return (x - icon_size - icon_gap, y, x + max_line_width, y + total_height), drawn_elements_info
 
-            else:
-                for i, line in enumerate(wrapped_text):
-                    text_x = x
-                    text_y = y + i * (line_height + gap)
-                    draw.text((text_x, text_y), line, text_color, font)
-                drawn_elements_info[key] = {"size": (max_line_width, text_y + line_height - y), "coordinates": (x, y), "font_size": font.size}
-
-                return (x, y, x + max_line_width, y + total_height), drawn_elements_info
-
-        elif element_type == "image" and image_obj:
-            img = image_obj
-
-            if "product" in key:
-                x = int(position[0] * width)
-                y = int(position[1] * height)
-                fixed_width = 450  # Fixed width for the product image bounding box
-                fixed_height = 450  # Fixed height for the product image bounding box
-
-                img = img.crop(img.getbbox())
-                img.thumbnail((fixed_width, fixed_height), Image.LANCZOS)
-                image.paste(img, (x, y), img)
-                drawn_elements_info[key] = {"size": (img.width, img.height), "coordinates": (x, y)}
-
-                return (x, y, x + img.width, y + img.height), drawn_elements_info  # Bounding box is removed
-            elif "logo" in key:
-                logo_width = int(size[0] * width)
-                logo_height = int(size[1] * height)
-
-                img = img.crop(img.getbbox())
-
-                # Reduce the height slightly to tighten the bounding box
-                reduction_factor = 0.7
-                logo_height = int(logo_height * reduction_factor)
-
-                img.thumbnail((logo_width, logo_height), Image.LANCZOS)
-
-                # Place the logo at the specified position
-                logo_x = int(position[0] * width)
-                logo_y = int(position[1] * height)
-
-                # Draw a white rounded rectangle patch with dynamic padding
-                patch_padding_top = int(logo_height * 0.1)  # 10% of the logo height
-                patch_padding_side = int(logo_width * 0.1)  # 10% of the logo width
-                patch_padding_bottom = int(logo_height * 0.05)  # 5% of the logo height
-
-                if position[0] > 0.5:  # Logo on the right
-                    patch_box = [
-                        logo_x - patch_padding_side,
-                        logo_y - patch_padding_top,
-                        logo_x + logo_width + patch_padding_side * 2,
-                        logo_y + logo_height + patch_padding_bottom
-                    ]
-                    corner_radius = 20  # Adjust this value as needed
-                    draw.rounded_rectangle(patch_box, radius=corner_radius, fill=(255, 255, 255))
-                else:  # Logo on the left
-                    patch_box = [
-                        logo_x - patch_padding_side * 2,
-                        logo_y - patch_padding_top,
-                        logo_x + logo_width + patch_padding_side,
-                        logo_y + logo_height + patch_padding_bottom
-                    ]
-                    corner_radius = 20  # Adjust this value as needed
-                    draw.rounded_rectangle(patch_box, radius=corner_radius, fill=(255, 255, 255))
-
-                # Paste the logo on top of the white patch
-                image.paste(img, (logo_x, logo_y), img)
-                drawn_elements_info[key] = {"size": (logo_width, logo_height), "coordinates": (logo_x, logo_y)}
-
-                return (logo_x, logo_y, logo_x + logo_width, logo_y + logo_height), drawn_elements_info
-
-    font_path_heading = "services/Fonts/ARIALBD.TTF"
-    font_path_desc = "services/Fonts/arial.ttf"
-    font_path_cta = "services/Fonts/ARIALBD.TTF"
-    font_path_contact = "services/Fonts/arial.ttf"
-    mobile_icon_path = "services/Fonts/icon.png"  # Replace with the actual path to the mobile icon
+        else:
+            for i, line in enumerate(wrapped_text):
+                text_x = x
+                text_y = y + i * (line_height + gap)
+                draw_text_line(draw, (text_x, text_y), line, text_color, font)
+            drawn_elements_info[key] = {"size": (max_line_width, text_y + line_height - y), "coordinates": (x, y), "font_size": font.size}
+
+            return (x, y, x + max_line_width, y + total_height), drawn_elements_info
+
+    elif element_type == "image" and image_obj:
+        img = image_obj
+
+        if "product" in key:
+            # The product comes from prepare_images, already fitted to PRODUCT_BOX_SIZE
+            image.alpha_composite(img, (x, y))
+            drawn_elements_info[key] = {"size": (img.width, img.height), "coordinates": (x, y)}
+
+            return (x, y, x + img.width, y + img.height), drawn_elements_info
+        elif "logo" in key:
+            # The logo comes from prepare_images, already trimmed and fitted
+            logo_width, logo_height = logo_box_size(size, width, height)
+
+            # Place the logo at the specified position
+            logo_x = int(position[0] * width)
+            logo_y = int(position[1] * height)
+
+            # Draw a white rounded rectangle patch with dynamic padding
+            patch_padding_top = int(logo_height * 0.1)  # 10% of the logo height
+            patch_padding_side = int(logo_width * 0.1)  # 10% of the logo width
+            patch_padding_bottom = int(logo_height * 0.05)  # 5% of the logo height
+
+            if position[0] > 0.5:  # Logo on the right
+                patch_box = [
+                    logo_x - patch_padding_side,
+                    logo_y - patch_padding_top,
+                    logo_x + logo_width + patch_padding_side * 2,
+                    logo_y + logo_height + patch_padding_bottom
+                ]
+                corner_radius = round(20 * scale)  # Adjust this value as needed
+                draw.rounded_rectangle(patch_box, radius=corner_radius, fill=(255, 255, 255))
+            else:  # Logo on the left
+                patch_box = [
+                    logo_x - patch_padding_side * 2,
+                    logo_y - patch_padding_top,
+                    logo_x + logo_width + patch_padding_side,
+                    logo_y + logo_height + patch_padding_bottom
+                ]
+                corner_radius = round(20 * scale)  # Adjust this value as needed
+                draw.rounded_rectangle(patch_box, radius=corner_radius, fill=(255, 255, 255))
+
+            # Paste the logo on top of the white patch
+            image.alpha_composite(img, (logo_x, logo_y))
+            drawn_elements_info[key] = {"size": (logo_width, logo_height), "coordinates": (logo_x, logo_y)}
+
+            return (logo_x, logo_y, logo_x + logo_width, logo_y + logo_height), drawn_elements_info
+
+# Occupancy index over the canvas at OCCUPANCY_CELL resolution. A summed-area
+# table answers "is this rectangle free" in O(1), and one vectorized pass over
+# it finds the free spot of a given size nearest to a point.
+OCCUPANCY_CELL = 10
+
+class OccupancyGrid:
+    def __init__(self, width, height, cell=OCCUPANCY_CELL):
+        self.width = width
+        self.height = height
+        self.cell = cell
+        self.cols = -(-width // cell)
+        self.rows = -(-height // cell)
+        self.occupied = np.zeros((self.rows, self.cols), dtype=bool)
+        self._table = None
+
+    def _cells(self, box):
+        # Every cell the box touches, clipped to the canvas
+        x1, y1, x2, y2 = box[:4]
+        return (
+            min(max(int(x1 // self.cell), 0), self.cols),
+            min(max(int(y1 // self.cell), 0), self.rows),
+            min(max(int(-(-x2 // self.cell)), 0), self.cols),
+            min(max(int(-(-y2 // self.cell)), 0), self.rows),
+        )
+
+    def _summed_area_table(self):
+        if self._table is None:
+            table = np.zeros((self.rows + 1, self.cols + 1), dtype=np.int32)
+            table[1:, 1:] = self.occupied.cumsum(axis=0).cumsum(axis=1)
+            self._table = table
+        return self._table
+
+    def mark(self, box):
+        c1, r1, c2, r2 = self._cells(box)
+        if c1 < c2 and r1 < r2:
+            self.occupied[r1:r2, c1:c2] = True
+            self._table = None
+
+    def is_free(self, box):
+        c1, r1, c2, r2 = self._cells(box)
+        table = self._summed_area_table()
+        return table[r2, c2] - table[r1, c2] - table[r2, c1] + table[r1, c1] == 0
+
+    def nearest_free(self, size, near):
+        # Top-left pixel of the free box of this size closest to `near`, or None
+        cols = -(-int(size[0]) // self.cell)
+        rows = -(-int(size[1]) // self.cell)
+        if cols > self.cols or rows > self.rows or cols <= 0 or rows <= 0:
+            return None
+        table = self._summed_area_table()
+        sums = table[rows:, cols:] - table[:-rows, cols:] - table[rows:, :-cols] + table[:-rows, :-cols]
+        free_rows, free_cols = np.nonzero(sums == 0)
+        if len(free_rows) == 0:
+            return None
+        distance = (free_cols * self.cell - near[0]) ** 2 + (free_rows * self.cell - near[1]) ** 2
+        best = np.argmin(distance)
+        return int(free_cols[best] * self.cell), int(free_rows[best] * self.cell)
+
+def draw_bounding_box(draw, box, color):
+    pass
+
+def adjust_and_draw_bounding_boxes(draw, bounding_boxes, width, height, expansion_factor=20, desc_expansion_factor=(75.59, 75.59)):
+    adjusted_boxes = []
+    for box in bounding_boxes:
+        if "desc" in box[-1]:
+            expansion_width, expansion_height = desc_expansion_factor
+        else:
+            expansion_width = expansion_height = expansion_factor
 
-    heading = format_title(heading)  # Ensure heading is limited to 4 words and formatted
-    highlighted_heading = heading  # No need to highlight any word now
-    highlight_font = ImageFont.truetype(font_path_heading, 40)  # Define the highlight font
+        x1, y1, x2, y2 = box[:4]
+        adjusted_box = (
+            max(x1 - expansion_width, 0),
+            max(y1 - expansion_height, 0),
+            min(x2 + expansion_width, width),
+            min(y2 + expansion_height, height)
+        )
+        adjusted_boxes.append(adjusted_box + (box[4],))
 
-    # Load the mobile icon
-    try:
-        mobile_icon = Image.open(mobile_icon_path).convert("RGBA")
-    except OSError:
-        print(f"Error opening mobile icon: {mobile_icon_path}")
-        mobile_icon = None
-
-    layouts = [
-        {
-            "logo": [(0.79, 0.0, 0.2, 0.15), logo_image, "image"],
-            "heading": [(0.08, 0.76, 0.6, 0.2), heading, "text", font_path_heading],
-            "desc_first_word": [(0.05, 0.37, 0.7, 0.15), desc, "text", font_path_desc],
-            "cta": [(0.2, 0.2, 0.2, 0.1), cta, "text", font_path_cta],
-            "contact": [(0.03, 0.05, 0.2, 0.1), contact, "text", font_path_contact],
-            "product": [(0.51, 0.3, 0.47, 0.5), product_image, "image"]
-        },
-        {
-            "logo": [(0.01, 0.0, 0.2, 0.15), logo_image, "image"],
-            "heading": [(0.3, 0.06, 0.6, 0.2), heading, "text", font_path_heading],
-            "desc_first_word": [(0.05, 0.32, 0.9, 0.15), desc, "text", font_path_desc],
-            "cta": [(0.2, 0.75, 0.2, 0.1), cta, "text", font_path_cta],
-            "contact": [(0.1, 0.92, 0.2, 0.1), contact, "text", font_path_contact],
-            "product": [(0.52, 0.25, 0.5, 0.6), product_image, "image"]
-        },
-        {
-            "logo": [(0.79, 0.0, 0.2, 0.15), logo_image, "image"],
-            "heading": [(0.05, 0.06, 0.6, 0.2), heading, "text", font_path_heading],
-            "desc_first_word": [(0.52, 0.38, 0.5, 0.55), desc, "text", font_path_desc],
-            "cta": [(0.18, 0.85, 0.2, 0.1), cta, "text", font_path_cta],
-            "contact": [(0.5, 0.85, 0.2, 0.1), contact, "text", font_path_contact],
-            "product": [(0.01, 0.27, 0.5, 0.5), product_image, "image"]
-        },
-        {
-            "logo": [(0.01, 0.0, 0.2, 0.15), logo_image, "image"],
-            "heading": [(0.3, 0.06, 0.6, 0.2), heading, "text", font_path_heading],
-            "desc_first_word": [(0.52, 0.38, 0.5, 0.55), desc, "text", font_path_desc],
-            "cta": [(0.18, 0.85, 0.2, 0.1), cta, "text", font_path_cta],
-            "contact": [(0.5, 0.85, 0.2, 0.1), contact, "text", font_path_contact],
-            "product": [(0.01, 0.27, 0.5, 0.5), product_image, "image"]
-        },
-        {
-            "logo": [(0.01, 0.0, 0.2, 0.15), logo_image, "image"],
-            "heading": [(0.04, 0.75, 0.6, 0.2), heading, "text", font_path_heading],
-            "desc_first_word": [(0.05, 0.32, 0.9, 0.15), desc, "text", font_path_desc],
-            "cta": [(0.65, 0.18, 0.2, 0.1), cta, "text", font_path_cta],
-            "contact": [(0.02, 0.18, 0.2, 0.1), contact, "text", font_path_contact],
-            "product": [(0.52, 0.25, 0.5, 0.6), product_image, "image"]
-        },
-        {
-            "logo": [(0.01, 0.0, 0.2, 0.15), logo_image, "image"],
-            "heading": [(0.3, 0.02, 0.6, 0.2), heading, "text", font_path_heading],
-            "desc_first_word": [(0.05, 0.37, 0.9, 0.15), desc, "text", font_path_desc],
-            "cta": [(0.65, 0.85, 0.2, 0.1), cta, "text", font_path_cta],
-            "contact": [(0.05, 0.87, 0.2, 0.1), contact, "text", font_path_contact],
-            "product": [(0.52, 0.30, 0.5, 0.6), product_image, "image"]
-        },
-        {
-            "logo": [(0.01, 0.0, 0.2, 0.15), logo_image, "image"],
-            "heading": [(0.07, 0.15, 0.6, 0.2), heading, "text", font_path_heading],
-            "desc_first_word": [(0.05, 0.42, 0.9, 0.15), desc, "text", font_path_desc],
-            "cta": [(0.65, 0.85, 0.2, 0.1), cta, "text", font_path_cta],
-            "contact": [(0.03, 0.87, 0.2, 0.1), contact, "text", font_path_contact],
-            "product": [(0.52, 0.35, 0.5, 0.6), product_image, "image"]
-        }
-    ]
+    for box in adjusted_boxes:
+        draw_bounding_box(draw, box[:4], color=(255, 255, 255, 0))
 
-    grid_width = 70
-    grid_height = 70
-
-    def generate_grid(width, height):
-        grid_cells = []
-        for x in range(0, width, grid_width):
-            for y in range(0, height, grid_height):
-                grid_cells.append((x, y, x + grid_width, y + height))
-        return grid_cells
-
-    def find_empty_spaces(bounding_boxes, width, height):
-        grid_cells = generate_grid(width, height)
-        empty_spaces = []
-        for cell in grid_cells:
-            cell_empty = True
-            for box in bounding_boxes:
-                if is_overlap(cell, box):
-                    cell_empty = False
-                    break
-            if cell_empty:
-                empty_spaces.append(cell)
-        return empty_spaces
-
-    def draw_bounding_box(draw, box, color):
-        pass
-
-    def get_analogous_colors(color):
-        r, g, b = color
-        analogous_1 = ((r + 30) % 256, (g + 30) % 256, (b + 30) % 256)
-        analogous_2 = ((r - 30) % 256, (g - 30) % 256, (b - 30) % 256)
-        return [analogous_1, analogous_2]
-
-    def filter_analogous_colors(color, palette):
-        def is_same_color_family(color1, color2):
-            return abs(color1[0] - color2[0]) <= 30 and abs(color1[1] - color2[1]) <= 30 and abs(color1[2] - color2[2]) <= 30
-
-        filtered_colors = []
-        for c in palette:
-            if is_same_color_family(color, c):
-                filtered_colors.append(c)
-
-        return filtered_colors
-
-    def adjust_and_draw_bounding_boxes(draw, bounding_boxes, expansion_factor=20, desc_expansion_factor=(75.59, 75.59)):
-        adjusted_boxes = []
-        for box in bounding_boxes:
-            if "desc" in box[-1]:
-                expansion_width, expansion_height = desc_expansion_factor
-            else:
-                expansion_width = expansion_height = expansion_factor
-
-            x1, y1, x2, y2 = box[:4]
-            adjusted_box = (
-                max(x1 - expansion_width, 0),
-                max(y1 - expansion_height, 0),
-                min(x2 + expansion_width, width),
-                min(y2 + expansion_height, height)
-            )
-            adjusted_boxes.append(adjusted_box + (box[4],))
+    return adjusted_boxes
 
-        for box in adjusted_boxes:
-            draw_bounding_box(draw, box[:4], color=(255, 255, 255, 0))
+MOBILE_ICON_PATH = "services/Fonts/icon.png"  # Replace with the actual path to the mobile icon
 
-        return adjusted_boxes
+@lru_cache(maxsize=None)
+def load_mobile_icon():
+    try:
+        return Image.open(MOBILE_ICON_PATH).convert("RGBA")
+    except OSError:
+        print(f"Error opening mobile icon: {MOBILE_ICON_PATH}")
+        return None
+
+# Layer cache. A layout is drawn as a background layer (the gradient), an image
+# layer (logo, its patch and the product) and a text pass on top. The first two
+# only depend on colors, assets and placement, so re-submitting the same assets
+# with edited copy only redraws the text.
+RENDER_CACHE_MAX_BYTES = int(os.environ.get('RENDER_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+def layer_nbytes(layer):
+    nbytes = 0
+    for part in layer:
+        if isinstance(part, Image.Image):
+            nbytes += part.width * part.height * len(part.getbands())
+        elif isinstance(part, bytes):
+            nbytes += len(part)
+    return nbytes
+
+layer_cache = LRUCache(max_bytes=RENDER_CACHE_MAX_BYTES, sizeof=layer_nbytes)
+
+def render_background_layer(chosen_colors, gradient_direction, width, height):
+    # Returns the gradient and its encoded PNG, keyed by (colors, direction, size)
+    cache_key = ("background", chosen_colors[0], chosen_colors[1], gradient_direction, width, height)
+    layer = layer_cache.get(cache_key)
+    if layer is None:
+        background = generate_gradient_color(chosen_colors[0], chosen_colors[1], width, height, direction=gradient_direction)
 
-    used_colors = set()
+        with io.BytesIO() as output:
+            background.save(output, format="PNG")
+            background_png = output.getvalue()
+
+        layer = (background, background_png)
+        layer_cache.put(cache_key, layer)
+    return layer
+
+# Layouts are described in a JSON spec (LAYOUTS_PATH) that is validated and
+# compiled once into plans: pixel rects, image target sizes, fonts and draw
+# order are all worked out up front, so a request only runs the plans.
+# Adding a layout is a change to the spec, not to the code.
+LAYOUTS_PATH = os.environ.get('LAYOUTS_PATH', 'services/layouts.json')
+
+# The element keys a layout may use, with their defaults. Every layout places
+# each of them exactly once. "source" names the request field or image drawn.
+LAYOUT_ELEMENTS = {
+    "logo": {"kind": "image", "source": "logo"},
+    "heading": {"kind": "text", "source": "heading", "font": FONT_PATH_HEADING, "max_font_size": 150},
+    "desc_first_word": {"kind": "text", "source": "desc", "font": FONT_PATH_DESC, "font_size": 40},
+    "cta": {"kind": "text", "source": "cta", "font": FONT_PATH_CTA, "font_size": 40},
+    "contact": {"kind": "text", "source": "contact", "font": FONT_PATH_CONTACT, "font_size": 50},
+    "product": {"kind": "image", "source": "product"},
+}
+
+# Elements without a font_size are fitted to their box, up to max_font_size
+LayoutElement = namedtuple('LayoutElement', ['key', 'source', 'box', 'rect', 'target_size', 'font_path', 'font_size', 'max_font_size', 'additional_size', 'min_font_size'])
+# Image elements are drawn first, then text, each in spec order. Plans compiled
+# at a scale below 1 (previews) have every pixel size scaled to match.
+LayoutPlan = namedtuple('LayoutPlan', ['id', 'width', 'height', 'scale', 'images', 'texts'])
+
+def scale_pixels(value, scale):
+    return max(1, round(value * scale))
+
+def compile_layout_element(element, width, height, scale=1.0):
+    if not isinstance(element, dict):
+        raise ValueError(f"elements must be objects, got {element!r}")
+    key = element.get("key")
+    if not isinstance(key, str) or key not in LAYOUT_ELEMENTS:
+        raise ValueError(f"unknown element {key!r}, expected one of {', '.join(LAYOUT_ELEMENTS)}")
+    unknown = set(element) - {"key", "box", "font", "font_size", "max_font_size", "additional_size"}
+    if unknown:
+        raise ValueError(f"{key}: unknown fields {', '.join(sorted(unknown))}")
+    box = element.get("box")
+    if not isinstance(box, list) or len(box) != 4 or not all(isinstance(v, (int, float)) and 0 <= v <= 1 for v in box):
+        raise ValueError(f"{key}: box must be [x, y, width, height] as fractions of the canvas")
+    for field in ("font_size", "max_font_size", "additional_size"):
+        if field in element and (isinstance(element[field], bool) or not isinstance(element[field], (int, float))):
+            raise ValueError(f"{key}: {field} must be a number")
+    if "font" in element and not isinstance(element["font"], str):
+        raise ValueError(f"{key}: font must be a path")
+
+    defaults = LAYOUT_ELEMENTS[key]
+    box = tuple(box)
+    rect = (int(box[0] * width), int(box[1] * height), int(box[2] * width), int(box[3] * height))
+    if defaults["kind"] == "image":
+        if key == "product":
+            target_size = (scale_pixels(PRODUCT_BOX_SIZE[0], scale), scale_pixels(PRODUCT_BOX_SIZE[1], scale))
+        else:
+            target_size = logo_box_size(box[2:], width, height)
+        return LayoutElement(key, defaults["source"], box, rect, target_size, None, None, None, 0, None)
 
-    background_urls = []
-    template_urls = []
+    font_path = element.get("font", defaults["font"])
+    # Fails here, at startup, rather than in the middle of a request
+    try:
+        open(font_path, 'rb').close()
+    except OSError as e:
+        raise ValueError(f"{key}: cannot read font {font_path}: {e.strerror or e}") from e
+    font_size = element.get("font_size", defaults.get("font_size"))
+    return LayoutElement(
+        key, defaults["source"], box, rect, None, font_path,
+        scale_pixels(font_size, scale) if font_size is not None else None,
+        scale_pixels(element.get("max_font_size", defaults.get("max_font_size", 100)), scale),
+        round(element.get("additional_size", 0) * scale),
+        scale_pixels(28, scale)
+    )
+
+def compile_layout_spec(spec, scale=1.0):
+    if not isinstance(spec, dict):
+        raise ValueError("Layout spec must be an object with a layouts list")
+    for field in ("width", "height"):
+        if field in spec and (isinstance(spec[field], bool) or not isinstance(spec[field], int) or spec[field] < 1):
+            raise ValueError(f"Layout spec {field} must be a positive integer")
+    width, height = scale_pixels(spec.get("width", 1080), scale), scale_pixels(spec.get("height", 1080), scale)
+    layouts = spec.get("layouts")
+    if not layouts or not isinstance(layouts, list):
+        raise ValueError("Layout spec has no layouts")
+
+    plans = []
+    for n, layout in enumerate(layouts):
+        if not isinstance(layout, dict):
+            raise ValueError(f"Layout {n + 1}: must be an object with an elements list")
+        layout_id = str(layout.get("id", n + 1))
+        # Ids name the uploaded files and are what requests select by
+        if any(plan.id == layout_id for plan in plans):
+            raise ValueError(f"Layout {layout_id}: duplicate id")
+        try:
+            elements = layout.get("elements", [])
+            if not isinstance(elements, list):
+                raise ValueError("elements must be a list")
+            elements = [compile_layout_element(element, width, height, scale) for element in elements]
+            keys = [element.key for element in elements]
+            if sorted(keys) != sorted(LAYOUT_ELEMENTS):
+                raise ValueError(f"must place each of {', '.join(LAYOUT_ELEMENTS)} exactly once, got {', '.join(keys)}")
+        except ValueError as e:
+            raise ValueError(f"Layout {layout_id}: {e}") from e
+        plans.append(LayoutPlan(
+            layout_id, width, height, scale,
+            tuple(element for element in elements if element.target_size is not None),
+            tuple(element for element in elements if element.target_size is None)
+        ))
+    return tuple(plans)
+
+# Bounded because previews may ask for any size
+@lru_cache(maxsize=16)
+def get_layout_plans(path=None, scale=1.0):
+    with open(path or LAYOUTS_PATH) as f:
+        return compile_layout_spec(json.load(f), scale)
+
+def select_layout_plans(layout_ids=None, layout_count=None, scale=1.0):
+    # The plans a request asked for: the given ids in the given order, then at
+    # most layout_count of them. By default every layout in the spec.
+    plans = get_layout_plans(scale=scale)
+    if layout_ids is not None:
+        by_id = {plan.id: plan for plan in plans}
+        layout_ids = list(dict.fromkeys(str(layout_id) for layout_id in layout_ids))
+        unknown = [layout_id for layout_id in layout_ids if layout_id not in by_id]
+        if unknown:
+            raise ValueError(f"Unknown layout ids: {', '.join(unknown)}")
+        plans = tuple(by_id[layout_id] for layout_id in layout_ids)
+    if layout_count is not None:
+        if layout_count < 1:
+            raise ValueError("layout_count must be at least 1")
+        plans = plans[:layout_count]
+    if not plans:
+        raise ValueError("No layouts selected")
+    return plans
+
+def select_request_plans(layout_ids=None, layout_count=None, style_layout_ids=None):
+    # The plans to render and the plans their styles are picked over; raises
+    # ValueError for a selection that cannot be rendered
+    plans = select_layout_plans(layout_ids, layout_count)
+    if style_layout_ids is None:
+        return plans, plans
+    style_plans = select_layout_plans(style_layout_ids)
+    missing = [plan.id for plan in plans if plan not in style_plans]
+    if missing:
+        raise ValueError(f"Layouts {', '.join(missing)} are not in style_layout_ids")
+    return plans, style_plans
+
+PRODUCT_BOX_SIZE = (550, 550)
+
+def logo_box_size(size, width, height):
+    # Reduce the height slightly to tighten the bounding box
+    reduction_factor = 0.7
+    # At least a pixel each way, so very small previews can still fit the logo
+    return max(1, int(size[0] * width)), max(1, int(int(size[1] * height) * reduction_factor))
+
+def prepare_images(plans, images):
+    # Trims the logo and resamples each image to every size the layouts draw it
+    # at, once per request. Layouts and cached layers only read the results;
+    # the source images are never modified.
+    sources = {"logo": images["logo"].crop(images["logo"].getbbox()), "product": images["product"]}
+    prepared = {}
+    for plan in plans:
+        for element in plan.images:
+            target = (element.source, element.target_size)
+            if target not in prepared:
+                img = sources[target[0]].copy()
+                img.thumbnail(target[1], Image.LANCZOS)
+                prepared[target] = img
+    return prepared
+
+def render_image_layer(image_elements, images, image_digests, width, height, scale=1.0):
+    # Returns a transparent layer with the image elements drawn on it, their
+    # bounding boxes and drawn elements info, keyed by (asset hashes, placement)
+    cache_key = None
+    if image_digests is not None:
+        cache_key = ("images", tuple(sorted(image_digests.items())), image_elements, width, height, scale)
+        layer = layer_cache.get(cache_key)
+        if layer is not None:
+            return layer
+
+    image = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    bounding_boxes = []
+    drawn_elements_info = {}
+
+    for element in image_elements:
+        key = element.key
+        img = images[(element.source, element.target_size)]
+
+        box, elem_info = draw_element(image, draw, key, element.box[:2], element.box[2:], element_type="image", image_obj=img, scale=scale)
+        drawn_elements_info.update(elem_info)
+        bounding_boxes.append(box + (key,))
+
+    layer = (image, tuple(bounding_boxes), drawn_elements_info)
+    if cache_key is not None:
+        layer_cache.put(cache_key, layer)
+    return layer
+
+# Layout positions are only a starting point for text: with AVOID_OVERLAPS on,
+# text that would cover the logo, the product or earlier text is moved to the
+# nearest free spot, but never further than OVERLAP_MAX_SHIFT pixels so the
+# layout keeps its design
+AVOID_OVERLAPS = os.environ.get('AVOID_OVERLAPS', '1') == '1'
+OVERLAP_MAX_SHIFT = int(os.environ.get('OVERLAP_MAX_SHIFT', '120'))
+
+def place_text_element(occupancy, key, pos, text, draw, font, mobile_icon, width, height, scale=1.0):
+    # Returns the position to draw at and the box the element will cover there
+    x, y = int(pos[0] * width), int(pos[1] * height)
+    dx1, dy1, dx2, dy2 = text_element_extent(key, text, draw, font, mobile_icon, scale)
+    box = (x + dx1, y + dy1, x + dx2, y + dy2)
+    if not AVOID_OVERLAPS or occupancy.is_free(box):
+        return pos, box
+
+    spot = occupancy.nearest_free((dx2 - dx1, dy2 - dy1), (x + dx1, y + dy1))
+    if spot is None or math.hypot(spot[0] - box[0], spot[1] - box[1]) > OVERLAP_MAX_SHIFT * scale:
+        return pos, box
+    x, y = spot[0] - dx1, spot[1] - dy1
+    # Half a pixel keeps int(pos * width) from rounding down a pixel
+    return ((x + 0.5) / width, (y + 0.5) / height) + tuple(pos[2:]), (spot[0], spot[1], spot[0] + dx2 - dx1, spot[1] + dy2 - dy1)
+
+def compose_layout(plan, texts, images, chosen_colors, gradient_direction, shapes, image_digests=None):
+    # Draws one compiled layout plan and returns the encoded background PNG,
+    # the composed template image and the drawn elements info. Plans compiled
+    # with a scale below 1 give a proportionally smaller preview of the layout.
+    mobile_icon = load_mobile_icon()
+    width, height, scale = plan.width, plan.height, plan.scale
+
+    background, background_png = render_background_layer(chosen_colors, gradient_direction, width, height)
+    image_layer, image_boxes, image_elements_info = render_image_layer(plan.images, images, image_digests, width, height, scale)
+
+    # Cached layers are shared, so compose onto a fresh canvas and copy their info
+    image = background.convert("RGBA")
+    image.alpha_composite(image_layer)
+    draw = ImageDraw.Draw(image)
+    drawn_elements_info = dict(image_elements_info)
+
+    occupancy = OccupancyGrid(width, height, cell=max(1, round(OCCUPANCY_CELL * scale)))
+    for box in image_boxes:
+        occupancy.mark(box)
+
+    highlight_color = (255, 255, 255)
+    heading_color = (255, 255, 255)
+    desc_color = (255, 255, 255)
+    contact_color = (255, 255, 255)
+
+    # Text is drawn last, on top of the background and image layers
+    for element in plan.texts:
+        key, pos, text = element.key, element.box, texts[element.source]
+        elem_type = "text"
+        text_color = (255, 255, 255)
+
+        if element.font_size is None:
+            max_width, max_height = element.rect[2:]
+            adjusted_font, font_size = adjust_font_size_based_on_space(draw, text, element.font_path, max_width, max_height, element.max_font_size, element.additional_size, element.min_font_size)
+        else:
+            adjusted_font = get_font(element.font_path, element.font_size)
 
-    layouts_info = []
+        wrapped_text = wrap_text(text, 30, draw, adjusted_font)[:6]
 
-    for i, elements in enumerate(layouts):
-        width, height = 1080, 1080
+        # Text that would cover something already drawn moves to the nearest free spot
+        pos, covered_box = place_text_element(occupancy, key, pos, '\n'.join(wrapped_text), draw, adjusted_font, mobile_icon, width, height, scale)
+        occupancy.mark(covered_box)
 
-        palette = get_palette(logo_image, color_count=6)
+        pos_x, pos_y = int(pos[0] * width), int(pos[1] * height)
+        pos_w, pos_h = int(pos[2] * width), int(pos[3] * height)
 
-        is_single_color = len(palette) == 1
-        palette_intensity_variations = []
+        sampled_background_color = sample_background_color(image, [(pos_x + pos_w // 2, pos_y + pos_h // 2)], area_size=max(2, round(10 * scale)))
+        sampled_background_rgb = tuple(sampled_background_color[:3])
 
-        if is_single_color:
-            base_color = Image.new('RGB', (width, height), palette[0])
-            palette_intensity_variations = [base_color.point(lambda p: p * (i / 5.0)) for i in range(1, 6)]
+        if key == "desc_first_word":
+            box, elem_info = draw_element(image, draw, key, pos[:2], pos[2:], '\n'.join(wrapped_text), adjusted_font, element_type=elem_type, cta_shape=shapes[0], text_color=text_color, background_color=sampled_background_rgb, scale=scale)
+        elif key == "cta":
+            cta_background_color = get_complementary_color(sampled_background_rgb)
+            cta_text_color = (255, 255, 255)
+            box, elem_info = draw_element(image, draw, key, pos[:2], pos[2:], '\n'.join(wrapped_text), adjusted_font, element_type=elem_type, cta_shape=shapes[1], text_color=cta_text_color, background_color=cta_background_color, scale=scale)
+        elif key == "contact":
+            box, elem_info = draw_element(image, draw, key, pos[:2], pos[2:], '\n'.join(wrapped_text), adjusted_font, element_type=elem_type, cta_shape="rectangle", text_color=contact_color, mobile_icon=mobile_icon, scale=scale)
         else:
-            palette_intensity_variations = palette
+            box, elem_info = draw_element(image, draw, key, pos[:2], pos[2:], '\n'.join(wrapped_text), adjusted_font, element_type=elem_type, cta_shape="rounded", text_color=text_color, scale=scale)
+        drawn_elements_info.update(elem_info)
+
+    return background_png, image, drawn_elements_info
+
+def render_layout(i, plan, texts, images, chosen_colors, gradient_direction, shapes, image_digests=None):
+    # Runs one compiled layout plan and returns the encoded background and
+    # template PNGs along with the drawn elements info. Everything it needs is
+    # passed in, so it can run in a worker process or thread as well as inline.
+    background_png, image, drawn_elements_info = compose_layout(plan, texts, images, chosen_colors, gradient_direction, shapes, image_digests)
+
+    with io.BytesIO() as output:
+        image.save(output, format="PNG")
+        template_png = output.getvalue()
+
+    print(f"Drawn elements info for layout {plan.id}: {drawn_elements_info}")
+
+    return background_png, template_png, drawn_elements_info
+
+# Parallel rendering. RENDER_WORKERS > 1 sends each layout to a pool; RENDER_EXECUTOR
+# picks a process pool (default) or a thread pool.
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', '1'))
+RENDER_EXECUTOR = os.environ.get('RENDER_EXECUTOR', 'process')
+
+render_pools = {}
+render_pools_lock = threading.Lock()
+
+def get_render_pool(executor, workers):
+    with render_pools_lock:
+        pool = render_pools.get((executor, workers))
+        if pool is None:
+            if executor == 'process':
+                # spawn rather than fork: the API process runs threads of its own
+                pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            elif executor == 'thread':
+                pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='render')
+            else:
+                raise ValueError(f"Unknown render executor: {executor}")
+            render_pools[(executor, workers)] = pool
+        return pool
+
+def share_image(image):
+    # Copy the decoded pixels into shared memory once; workers map them instead
+    # of receiving a pickled copy per layout
+    pixels = np.asarray(image)
+    shm = shared_memory.SharedMemory(create=True, size=pixels.nbytes)
+    np.ndarray(pixels.shape, dtype=pixels.dtype, buffer=shm.buf)[:] = pixels
+    return shm, (shm.name, image.mode, image.size)
+
+def render_layout_shared(i, plan, texts, image_refs, *args):
+    # Worker side of share_image: wraps the shared buffers as read-only images
+    attached = []
+    images = {}
+    try:
+        for name, (shm_name, mode, size) in image_refs.items():
+            shm = shared_memory.SharedMemory(name=shm_name)
+            attached.append(shm)
+            images[name] = Image.frombuffer(mode, size, shm.buf, 'raw', mode, 0, 1)
+        return render_layout(i, plan, texts, images, *args)
+    finally:
+        images.clear()
+        for shm in attached:
+            shm.close()
+
+# S3 uploads. One client per process, shared by every request and upload
+# thread (boto3 clients are thread-safe). S3_ENDPOINT_URL points it at a
+# local S3 stand-in such as moto_server or MinIO.
+S3_BUCKET_NAME = "sparkiq-image-upload"
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') or None
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', '32'))
+S3_UPLOAD_WORKERS = int(os.environ.get('S3_UPLOAD_WORKERS', '16'))
+
+@lru_cache(maxsize=None)
+def get_s3_client():
+    config = Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS, retries={'max_attempts': 3, 'mode': 'standard'})
+    return boto3.client('s3', endpoint_url=S3_ENDPOINT_URL, config=config)
+
+@lru_cache(maxsize=None)
+def get_upload_pool():
+    return ThreadPoolExecutor(max_workers=S3_UPLOAD_WORKERS, thread_name_prefix='s3-upload')
+
+def upload_to_s3(file_bytes, file_name, s3_client=None):
+    s3_client = s3_client or get_s3_client()
+    with io.BytesIO(file_bytes) as file:
+        try:
+            s3_client.upload_fileobj(file, S3_BUCKET_NAME, file_name, ExtraArgs={'ACL': 'public-read'})
+            print(f"Image {file_name} uploaded to S3 successfully.")
+            return f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{file_name}"
+        except NoCredentialsError:
+            print("Credentials not available for S3 upload.")
+            return None
+
+# Client assets (logos, product shots) are stored under the SHA-256 of their
+# bytes. A local index remembers which keys are already in the bucket, so a
+# repeat asset costs no network calls at all.
+S3_INDEX_PATH = os.environ.get('S3_INDEX_PATH', 's3_index.sqlite3')
+
+ASSET_EXTENSIONS = {'PNG': '.png', 'JPEG': '.jpg', 'WEBP': '.webp', 'GIF': '.gif'}
+
+class UploadIndex:
+    def __init__(self, path):
+        self.path = path
+        self._known = set()
+        self._lock = threading.Lock()
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS uploaded (key TEXT PRIMARY KEY, uploaded_at REAL NOT NULL)")
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._known:
+                return True
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn:
+            found = conn.execute("SELECT 1 FROM uploaded WHERE key = ?", (key,)).fetchone() is not None
+        if found:
+            with self._lock:
+                self._known.add(key)
+        return found
+
+    def add(self, key):
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn, conn:
+            conn.execute("INSERT OR IGNORE INTO uploaded (key, uploaded_at) VALUES (?, ?)", (key, time.time()))
+        with self._lock:
+            self._known.add(key)
+
+@lru_cache(maxsize=None)
+def get_upload_index():
+    return UploadIndex(S3_INDEX_PATH)
+
+def asset_key(digest, image_format):
+    extension = ASSET_EXTENSIONS.get(image_format, f".{image_format.lower()}" if image_format else "")
+    return f"assets/{digest}{extension}"
+
+def upload_asset(file_bytes, key, s3_client=None):
+    if key in get_upload_index():
+        return f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{key}"
+
+    url = upload_to_s3(file_bytes, key, s3_client)
+    if url:
+        get_upload_index().add(key)
+    return url
+
+# Uploads are never decoded at full size. The pixel limit is checked against the
+# header before any decoding, JPEGs are decoded at a reduced DCT scale (draft)
+# and thumbnail() shrinks by an integer factor with reduce() before its final
+# LANCZOS pass, so only the working-size image is ever converted to RGBA.
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', str(50 * 1000 * 1000)))
+# Every layout shows the product within 550x550. Logos are drawn at most about
+# 220 px wide; they are trimmed before shrinking, and the extra size keeps them
+# sharp for the patch and palette.
+PRODUCT_WORKING_SIZE = PRODUCT_BOX_SIZE
+LOGO_WORKING_SIZE = (1024, 1024)
+
+def load_image(image_bytes, max_size, max_pixels=MAX_IMAGE_PIXELS, trim=False):
+    # Returns the source format and an RGBA image that fits within max_size.
+    # With trim, transparent margins are cropped away at source resolution
+    # first, so a logo exported on a large canvas keeps its detail.
+    image = Image.open(io.BytesIO(image_bytes))
+    image_format = image.format
+    if image.width * image.height > max_pixels:
+        raise ValueError(f"Image is {image.width}x{image.height}, larger than the {max_pixels} pixel limit")
+
+    if image_format == 'JPEG':
+        # Twice the target keeps enough detail for the LANCZOS pass
+        image.draft('RGB' if image.mode == 'RGB' else None, (max_size[0] * 2, max_size[1] * 2))
+    if image.mode not in ('RGB', 'RGBA', 'L'):
+        # Palette and other modes cannot be resampled directly
+        image = image.convert('RGBA')
+    if trim and image.mode == 'RGBA':
+        bbox = image.getbbox()
+        if bbox:
+            image = image.crop(bbox)
+    image.thumbnail(max_size, Image.LANCZOS)
+    return image_format, image.convert('RGBA')
+
+# Finished requests are cached by a hash of the complete request, so a client
+# retrying after a timeout gets the earlier layouts back without a re-render.
+# Entries live in memory and in a SQLite file that survives restarts, and expire
+# after RESULT_CACHE_TTL seconds (0 turns caching off).
+RESULT_CACHE_PATH = os.environ.get('RESULT_CACHE_PATH', 'results.sqlite3')
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', str(24 * 3600)))
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', '256'))
+RESULT_CACHE_MAX_DISK_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_DISK_ENTRIES', '10000'))
+
+class ResultCache:
+    def __init__(self, path, ttl_seconds=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_SIZE, max_disk_entries=RESULT_CACHE_MAX_DISK_ENTRIES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_entries = max_disk_entries
+        self._memory = LRUCache(max_entries)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, expires_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS results_created ON results (created_at)")
+
+    def get(self, key):
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None and entry[0] > now:
+            return copy.deepcopy(entry[1])
+
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn:
+            row = conn.execute("SELECT value, expires_at FROM results WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+        if row is None:
+            return None
+        value = json.loads(row[0])
+        self._memory.put(key, (row[1], value))
+        return copy.deepcopy(value)
+
+    def put(self, key, value):
+        if self.ttl_seconds <= 0:
+            return
+        now = time.time()
+        expires_at = now + self.ttl_seconds
+        self._memory.put(key, (expires_at, copy.deepcopy(value)))
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO results (key, value, created_at, expires_at) VALUES (?, ?, ?, ?)", (key, json.dumps(value), now, expires_at))
+            conn.execute("DELETE FROM results WHERE expires_at <= ?", (now,))
+            conn.execute(
+                "DELETE FROM results WHERE key NOT IN (SELECT key FROM results ORDER BY created_at DESC LIMIT ?)",
+                (self.max_disk_entries,)
+            )
 
-        all_colors = []
-        for color in palette:
-            rgb_color = tuple(int(color[i:i+2], 16) for i in (1, 3, 5))
-            analogous_colors = get_analogous_colors(rgb_color)
-            all_colors.append(rgb_color)
-            all_colors.extend(filter_analogous_colors(rgb_color, analogous_colors))
+    def get_or_compute(self, key, compute, should_store=None):
+        # Concurrent calls for the same key in this process share one compute();
+        # the others wait for its result (or its exception)
+        value = self.get(key)
+        if value is not None:
+            print(f"Returning cached result for request {key}")
+            return value
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+
+        if not leader:
+            print(f"Waiting for identical request {key} already in progress")
+            return copy.deepcopy(future.result())
 
-        unique_colors = list(set(all_colors))
-        hex_colors = ['#{:02x}{:02x}{:02x}'.format(r, g, b) for r, g, b in unique_colors]
+        try:
+            value = compute()
+            if should_store is None or should_store(value):
+                self.put(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+result_cache = None
+result_cache_lock = threading.Lock()
+
+def get_result_cache():
+    # Created under a lock: coalescing only works if all threads share one instance
+    global result_cache
+    with result_cache_lock:
+        if result_cache is None:
+            result_cache = ResultCache(RESULT_CACHE_PATH)
+        return result_cache
+
+# Rendering is random by default. Given a seed, every random choice comes from a
+# per-request generator instead, so identical requests render identical
+# templates. With DETERMINISTIC_RENDERING=1 the seed is derived from the uploaded
+# assets when the client does not send one. The copy is left out, so editing
+# only the text keeps the colors and gradients and reuses the background layers.
+DETERMINISTIC_RENDERING = os.environ.get('DETERMINISTIC_RENDERING', '0') == '1'
+# Bump whenever a change alters the rendered output, so older results are not reused.
+# 4: analytic CTA buttons, which version 2 results were cached both with and without.
+# 5: logos trimmed before shrinking, which version 2-4 logos with wide margins were not.
+RENDER_VERSION = '5'
+
+def asset_seed(logo_digest, product_digest):
+    return hashlib.sha256(json.dumps(["seed", logo_digest, product_digest]).encode()).hexdigest()
+
+def request_key(heading, desc, cta, contact, logo_digest, product_digest, seed=None, layout_ids=None, style_layout_ids=None):
+    content = json.dumps([RENDER_VERSION, heading, desc, cta, contact, logo_digest, product_digest, seed, layout_ids, style_layout_ids])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def is_complete_result(layouts_info):
+    # A failed upload leaves a URL missing; such results are not cached
+    return all(info["logoUrl"] and info["imageURL"] and info["logoImageUrl"] and info["productImageUrl"] for info in layouts_info)
+
+def choose_layout_styles(plans, hex_colors, rng):
+    # Random choices are made up front, in layout order, so the rendering itself
+    # can run anywhere and still match the serial path
+    # Logos with one or two colors have fewer distinct ordered pairs than there
+    # are layouts; once all are used, pairs repeat instead of being searched for
+    # forever. A single color gives a flat background.
+    if len(hex_colors) < 2:
+        hex_colors = tuple(hex_colors) * 2
+    distinct_colors = len(set(hex_colors))
+    pair_count = distinct_colors * (distinct_colors - 1) or 1
 
+    used_colors = set()
+    layout_choices = []
+    for plan in plans:
+        if len(used_colors) >= pair_count:
+            used_colors.clear()
         while True:
-            chosen_colors = random.sample(hex_colors, 2)
+            chosen_colors = rng.sample(hex_colors, 2)
             if tuple(chosen_colors) not in used_colors:
                 used_colors.add(tuple(chosen_colors))
                 break
 
-        print(f"Layout {i + 1} - Chosen colors: {chosen_colors}")
+        print(f"Layout {plan.id} - Chosen colors: {chosen_colors}")
 
-        directions = ['left_to_right', 'top_to_bottom', 'right_to_left', 'bottom_to_top', 'diagonal_tl_br', 'diagonal_bl_tr']
-        gradient_direction = random.choice(directions)
+        gradient_direction = rng.choice(GRADIENT_DIRECTIONS)
 
-        background = generate_gradient_color(chosen_colors[0], chosen_colors[1], width, height, direction=gradient_direction)
+        shapes = ["rounded", "rectangle"]
+        rng.shuffle(shapes)
 
-        background_image_path = f"background_{i + 1}.png"
-        background.save(background_image_path, quality=95)
+        layout_choices.append((chosen_colors, gradient_direction, shapes))
+    return layout_choices
 
-        if os.path.exists(background_image_path):
-            print(f"Background image {background_image_path} saved successfully.")
-        else:
-            print(f"Failed to save background image {background_image_path}.")
+# Define the generate_ad_template function
+def generate_ad_template(heading, desc, cta, contact, logo_bytes, product_bytes, workers=None, executor=None, s3_client=None, seed=None, logo_digest=None, product_digest=None, layout_ids=None, layout_count=None, style_layout_ids=None):
+    # Callers that hashed the uploads while reading them pass the digests in.
+    # style_layout_ids lets a request rendered in parts (preview_first) pick
+    # colors and shapes over the whole selection, so each part matches the
+    # render of the whole; by default styles are drawn over the rendered layouts.
+    logo_digest = logo_digest or hashlib.sha256(logo_bytes).hexdigest()
+    product_digest = product_digest or hashlib.sha256(product_bytes).hexdigest()
+
+    if seed is None and DETERMINISTIC_RENDERING:
+        seed = asset_seed(logo_digest, product_digest)
+
+    # Only the selected layouts are rendered, uploaded and returned
+    plans, style_plans = select_request_plans(layout_ids, layout_count, style_layout_ids)
+
+    key = request_key(heading, desc, cta, contact, logo_digest, product_digest, seed, [plan.id for plan in plans], [plan.id for plan in style_plans])
+    return get_result_cache().get_or_compute(
+        key,
+        lambda: render_ad_template(heading, desc, cta, contact, logo_bytes, product_bytes, logo_digest, product_digest, key, plans, seed, workers, executor, s3_client, style_plans),
+        is_complete_result
+    )
+
+def render_ad_template(heading, desc, cta, contact, logo_bytes, product_bytes, logo_digest, product_digest, key, plans, seed=None, workers=None, executor=None, s3_client=None, style_plans=None):
+    rng = random.Random(seed) if seed is not None else random
+    # Each request gets its own keys so cached URLs are never overwritten
+    render_prefix = f"renders/{key}/"
+
+    # Load the images, already shrunk to the size the layouts need
+    logo_format, logo_image = load_image(logo_bytes, LOGO_WORKING_SIZE, trim=True)
+    product_format, product_image = load_image(product_bytes, PRODUCT_WORKING_SIZE)
+    logo_key = asset_key(logo_digest, logo_format)
+    product_key = asset_key(product_digest, product_format)
+
+    s3_client = s3_client or get_s3_client()
+    upload_pool = get_upload_pool()
+
+    # Uploads run in the background while the layouts render
+    logo_upload = upload_pool.submit(upload_asset, logo_bytes, logo_key, s3_client)
+    product_upload = upload_pool.submit(upload_asset, product_bytes, product_key, s3_client)
 
-        try:
-            s3_client.upload_file(background_image_path, bucket_name, background_image_path, ExtraArgs={'ACL': 'public-read'})
-            background_url = f"https://{bucket_name}.s3.amazonaws.com/{background_image_path}"
-            background_urls.append(background_url)
-            print(f"Background image {background_image_path} uploaded to S3 successfully.")
-        except NoCredentialsError:
-            print("Credentials not available for S3 upload.")
+    heading = format_title(heading)  # Ensure heading is limited to 4 words and formatted
+    texts = {"heading": heading, "desc": desc, "cta": cta, "contact": contact}
 
-        image = Image.new("RGBA", (width, height))
-        image.paste(background, (0, 0))
-        draw = ImageDraw.Draw(image)
-        bounding_boxes = []
-        drawn_elements_info = {}
+    # Palette and color candidates are shared by all layouts of the request
+    palette, hex_colors = get_logo_colors(logo_image, logo_digest, color_count=6)
 
-        dominant_color = get_dominant_color(image)
-        highlight_color = (255, 255, 255)
-        heading_color = (255, 255, 255)
-        desc_color = (255, 255, 255)
-        contact_color = (255, 255, 255)
+    background_urls = []
+    template_urls = []
 
-        shapes = ["rounded", "rectangle"]
-        random.shuffle(shapes)
-
-        for key, value in elements.items():
-            pos, text, elem_type, *font = value
-            pos_x, pos_y = int(pos[0] * width), int(pos[1] * height)
-            pos_w, pos_h = int(pos[2] * width), int(pos[3] * height)
-
-            sampled_background_color = sample_background_color(image, [(pos_x + pos_w // 2, pos_y + pos_h // 2)])
-            sampled_background_rgb = tuple(sampled_background_color[:3])
-            complementary_color = get_complementary_color(sampled_background_rgb)
-
-            if elem_type == "text":
-                max_width = int(pos[2] * width)
-                max_height = int(pos[3] * height)
-                max_font_size = 150 if key == "heading" else 100
-                if key == "heading":
-                    additional_size = font[1] if len(font) > 1 else 0
-                    adjusted_font, font_size = adjust_font_size_based_on_space(draw, text, font[0], max_width, max_height, max_font_size, additional_size)
-                    text_color = (255, 255, 255)
-                elif key == "desc_first_word":
-                    adjusted_font = ImageFont.truetype(font[0], 40)
-                    font_size = 40
-                    text_color = (255, 255, 255)
-                elif key == "contact":
-                    adjusted_font = ImageFont.truetype(font[0], 50)
-                    font_size = 50
-                    text_color = (255, 255, 255)
-                else:
-                    adjusted_font = ImageFont.truetype(font[0], 40)
-                    font_size = 40
-                    text_color = (255, 255, 255)
-
-                wrapped_text = wrap_text(text, 30, draw, adjusted_font)[:6]
-                if key == "desc_first_word":
-                    box, elem_info = draw_element(draw, key, pos[:2], pos[2:], '\n'.join(wrapped_text), adjusted_font, element_type=elem_type, cta_shape=shapes[0], text_color=text_color, background_color=sampled_background_rgb)
-                elif key == "cta":
-                    cta_background_color = get_complementary_color(sampled_background_rgb)
-                    cta_text_color = (255, 255, 255)
-                    box, elem_info = draw_element(draw, key, pos[:2], pos[2:], '\n'.join(wrapped_text), adjusted_font, element_type=elem_type, cta_shape=shapes[1], text_color=cta_text_color, background_color=cta_background_color)
-                elif key == "contact":
-                    box, elem_info = draw_element(draw, key, pos[:2], pos[2:], '\n'.join(wrapped_text), adjusted_font, element_type=elem_type, cta_shape="rectangle", text_color=contact_color, mobile_icon=mobile_icon)
-                else:
-                    box, elem_info = draw_element(draw, key, pos[:2], pos[2:], '\n'.join(wrapped_text), adjusted_font, element_type=elem_type, cta_shape="rounded", text_color=text_color)
-                bounding_boxes.append(box + (key,))
-                drawn_elements_info.update(elem_info)
-            else:
-                img = text
-
-                if key == "product":
-                    pos_x = int(pos[0] * width)
-                    pos_y = int(pos[1] * height)
-                    fixed_width = 550
-                    fixed_height = 550
-                    img.thumbnail((fixed_width, fixed_height), Image.LANCZOS)
-                    image.paste(img, (pos_x, pos_y), img)
-                    box = (pos_x, pos_y, pos_x + img.width, pos_y + img.height)
-                    drawn_elements_info[key] = {"size": (img.width, img.height), "coordinates": (pos_x, pos_y)}
-                elif "logo" in key:
-                    box, elem_info = draw_element(draw, key, pos[:2], pos[2:], element_type=elem_type, image_obj=img)
-                    drawn_elements_info.update(elem_info)
-                    bounding_boxes.append(box + (key,))
-
-        adjusted_boxes = adjust_and_draw_bounding_boxes(draw, bounding_boxes)
-
-        template_image_path = f"ad_template_{i + 1}.png"
-        image.save(template_image_path, quality=95)
-
-        if os.path.exists(template_image_path):
-            print(f"Template image {template_image_path} saved successfully.")
+    layouts_info = []
+
+    style_plans = style_plans or plans
+    style_choices = dict(zip((plan.id for plan in style_plans), choose_layout_styles(style_plans, hex_colors, rng)))
+    layout_choices = [style_choices[plan.id] for plan in plans]
+
+    workers = RENDER_WORKERS if workers is None else workers
+    executor = executor or RENDER_EXECUTOR
+    images = prepare_images(plans, {"logo": logo_image, "product": product_image})
+    image_digests = {"logo": logo_digest, "product": product_digest}
+    shared_images = []
+
+    try:
+        if workers <= 1:
+            results = (render_layout(i, plan, texts, images, *layout_choices[i], image_digests) for i, plan in enumerate(plans))
         else:
-            print(f"Failed to save template image {template_image_path}.")
+            pool = get_render_pool(executor, workers)
+            if executor == 'process':
+                image_refs = {}
+                for name, img in images.items():
+                    shm, image_refs[name] = share_image(img)
+                    shared_images.append(shm)
+                futures = [pool.submit(render_layout_shared, i, plan, texts, image_refs, *layout_choices[i], image_digests) for i, plan in enumerate(plans)]
+            else:
+                futures = [pool.submit(render_layout, i, plan, texts, images, *layout_choices[i], image_digests) for i, plan in enumerate(plans)]
+            # Collected in submission order so layouts_info matches the serial path
+            results = (future.result() for future in futures)
+
+        rendered = []
+        for i, (background_png, template_png, drawn_elements_info) in enumerate(results):
+            # Encoded images go straight from memory to S3, nothing is written to disk.
+            # Each upload starts as soon as its layout is ready.
+            background_upload = upload_pool.submit(upload_to_s3, background_png, f"{render_prefix}background_{plans[i].id}.png", s3_client)
+            template_upload = upload_pool.submit(upload_to_s3, template_png, f"{render_prefix}ad_template_{plans[i].id}.png", s3_client)
+            rendered.append((drawn_elements_info, background_upload, template_upload))
+
+    finally:
+        for shm in shared_images:
+            shm.close()
+            shm.unlink()
+
+    logo_url = logo_upload.result()
+    product_url = product_upload.result()
+
+    for i, (drawn_elements_info, background_upload, template_upload) in enumerate(rendered):
+        chosen_colors, gradient_direction, shapes = layout_choices[i]
+        plan = plans[i]
+        fonts = {element.key: element.font_path for element in plan.texts}
+
+        background_url = background_upload.result()
+        if background_url:
+            background_urls.append(background_url)
 
-        try:
-            s3_client.upload_file(template_image_path, bucket_name, template_image_path, ExtraArgs={'ACL': 'public-read'})
-            template_url = f"https://{bucket_name}.s3.amazonaws.com/{template_image_path}"
+        template_url = template_upload.result()
+        if template_url:
             template_urls.append(template_url)
-            print(f"Template image {template_image_path} uploaded to S3 successfully.")
-        except NoCredentialsError:
-            print("Credentials not available for S3 upload.")
 
         title_font_size = drawn_elements_info['heading']['font_size'] if 'heading' in drawn_elements_info else None
         cta_font_size = drawn_elements_info['cta']['font_size'] if 'cta' in drawn_elements_info else None
@@ -641,9 +1445,9 @@ def generate_ad_template(heading, desc, cta, contact, logo_bytes, product_bytes)
         contact_font_size = drawn_elements_info['contact']['font_size'] if 'contact' in drawn_elements_info else None
 
         layout_info = {
-            "id": str(i + 1),
+            "id": plan.id,
             "bgcolor": f"{chosen_colors[0]},{chosen_colors[1]}",
-            "imagelayoutsize": f"{width}x{height}",
+            "imagelayoutsize": f"{plan.width}x{plan.height}",
             "logoUrl": background_url,
             "imageURL": template_url,
             "aiModel": "AI-Model-Name",
@@ -652,11 +1456,11 @@ def generate_ad_template(heading, desc, cta, contact, logo_bytes, product_bytes)
             "logoWidth": drawn_elements_info['logo']['size'][0],
             "title": heading,
             "titlePosition": f"{drawn_elements_info['heading']['coordinates'][0]},{drawn_elements_info['heading']['coordinates'][1]}",
-            "fontstyle": get_font_name(font_path_heading),
+            "fontstyle": get_font_name(fonts['heading']),
             "fontSize": title_font_size,
             "description": desc,
             "descriptionPosition": f"{drawn_elements_info['desc_first_word']['coordinates'][0]},{drawn_elements_info['desc_first_word']['coordinates'][1]}",
-            "descriptionFontstyle": get_font_name(font_path_desc),
+            "descriptionFontstyle": get_font_name(fonts['desc_first_word']),
             "descriptionFontSize": desc_font_size,
             "ctaButtonText": cta,
             "ctaStyle": shapes[1],
@@ -666,7 +1470,7 @@ def generate_ad_template(heading, desc, cta, contact, logo_bytes, product_bytes)
             "ctaButtonWidth": drawn_elements_info['cta_button']['size'][0],
             "phoneNumberText": contact,
             "phoneNumberPosition": f"{drawn_elements_info['contact']['coordinates'][0]},{drawn_elements_info['contact']['coordinates'][1]}",
-            "phoneNumberFontStyle": get_font_name(font_path_contact),
+            "phoneNumberFontStyle": get_font_name(fonts['contact']),
             "phoneNumberSize": contact_font_size,
             "logoImageUrl": logo_url,  # Add logo URL
             "productImageUrl": product_url  # Add product URL
@@ -674,30 +1478,129 @@ def generate_ad_template(heading, desc, cta, contact, logo_bytes, product_bytes)
 
         layouts_info.append(layout_info)
 
-        print(f"Layout {i + 1} - Title font size: {title_font_size}, CTA font size: {cta_font_size}, Description font size: {desc_font_size}, Contact font size: {contact_font_size}")
+        print(f"Layout {plan.id} - Title font size: {title_font_size}, CTA font size: {cta_font_size}, Description font size: {desc_font_size}, Contact font size: {contact_font_size}")
 
-        empty_spaces = find_empty_spaces(adjusted_boxes, width, height)
-        print(f"Drawn elements info for layout {i + 1}: {drawn_elements_info}")
         print(f"Layout _info: {layouts_info}")
         #post_data(layouts_info)
 
     return layouts_info
-# Function to post data
-def post_data(data_array):
-    url = 'http://dev.api.sparkiq.ai/generate-images'
-    for data in data_array:
-        try:
-            print(f"Sending data: {json.dumps(data, indent=4)}")
-            response = requests.post(url, headers={'Content-Type': 'application/json'}, data=json.dumps(data))
-            response.raise_for_status()  # Check for HTTP errors
-            print('POST response:', json.dumps(response.json(), indent=4))
-        except requests.exceptions.RequestException as e:
-            print('Error:', e)
-    
-    # After posting all data, make a GET request to fetch all data
+
+# Previews draw the same layouts as generate_ad_template, with the same seed and
+# so the same colors, gradients and CTA shapes, but compiled at PREVIEW_SIZE
+# pixels wide and returned as small JPEG/WebP bytes. Nothing is uploaded,
+# cached or posted, so a preview costs a few tens of milliseconds per layout.
+PREVIEW_SIZE = int(os.environ.get('PREVIEW_SIZE', '270'))
+PREVIEW_FORMAT = os.environ.get('PREVIEW_FORMAT', 'JPEG').upper()
+PREVIEW_QUALITY = int(os.environ.get('PREVIEW_QUALITY', '80'))
+PREVIEW_FORMATS = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+
+def generate_ad_preview(heading, desc, cta, contact, logo_bytes, product_bytes, size=None, image_format=None, seed=None, layout_ids=None, layout_count=None, logo_digest=None, product_digest=None):
+    # Returns one {"id", "bgcolor", "format", "image"} dict per selected layout,
+    # where image holds the encoded preview bytes
+    size = PREVIEW_SIZE if size is None else size
+    image_format = (PREVIEW_FORMAT if image_format is None else image_format).upper()
+    if image_format not in PREVIEW_FORMATS:
+        raise ValueError(f"Unsupported preview format {image_format!r}, expected one of {', '.join(PREVIEW_FORMATS)}")
+
+    logo_digest = logo_digest or hashlib.sha256(logo_bytes).hexdigest()
+    product_digest = product_digest or hashlib.sha256(product_bytes).hexdigest()
+    if seed is None and DETERMINISTIC_RENDERING:
+        seed = asset_seed(logo_digest, product_digest)
+    rng = random.Random(seed) if seed is not None else random
+
+    # size is the preview width; the full-size plans give the scale
+    full_width = select_layout_plans(layout_ids, layout_count)[0].width
+    if not 1 <= size <= full_width:
+        raise ValueError(f"Preview size must be between 1 and {full_width}, got {size}")
+    scale = size / full_width
+    plans = select_layout_plans(layout_ids, layout_count, scale)
+
+    # The logo keeps its full working size so the palette matches the full render
+    logo_format, logo_image = load_image(logo_bytes, LOGO_WORKING_SIZE, trim=True)
+    product_size = tuple(scale_pixels(v, scale) for v in PRODUCT_WORKING_SIZE)
+    product_format, product_image = load_image(product_bytes, product_size)
+
+    texts = {"heading": format_title(heading), "desc": desc, "cta": cta, "contact": contact}
+    palette, hex_colors = get_logo_colors(logo_image, logo_digest, color_count=6)
+    layout_choices = choose_layout_styles(plans, hex_colors, rng)
+
+    images = prepare_images(plans, {"logo": logo_image, "product": product_image})
+    image_digests = {"logo": logo_digest, "product": product_digest}
+
+    previews = []
+    for plan, (chosen_colors, gradient_direction, shapes) in zip(plans, layout_choices):
+        background_png, image, drawn_elements_info = compose_layout(plan, texts, images, chosen_colors, gradient_direction, shapes, image_digests)
+        with io.BytesIO() as output:
+            image.convert("RGB").save(output, format=image_format, quality=PREVIEW_QUALITY)
+            previews.append({
+                "id": plan.id,
+                "bgcolor": f"{chosen_colors[0]},{chosen_colors[1]}",
+                "format": PREVIEW_FORMATS[image_format],
+                "image": output.getvalue(),
+            })
+    return previews
+
+# Downstream delivery of the layouts. One pooled session per process keeps
+# connections alive; urllib3 retries failed calls with exponential backoff.
+DELIVERY_URL = os.environ.get('DELIVERY_URL', 'http://dev.api.sparkiq.ai/generate-images')
+DELIVERY_CONNECT_TIMEOUT = float(os.environ.get('DELIVERY_CONNECT_TIMEOUT', '3'))
+DELIVERY_READ_TIMEOUT = float(os.environ.get('DELIVERY_READ_TIMEOUT', '10'))
+DELIVERY_RETRIES = int(os.environ.get('DELIVERY_RETRIES', '3'))
+DELIVERY_BACKOFF = float(os.environ.get('DELIVERY_BACKOFF', '0.5'))
+DELIVERY_CONCURRENCY = int(os.environ.get('DELIVERY_CONCURRENCY', '8'))
+# Send all layouts as one JSON array, for downstreams that accept batches
+DELIVERY_BATCH = os.environ.get('DELIVERY_BATCH', '0') == '1'
+
+@lru_cache(maxsize=None)
+def get_delivery_session():
+    retry = Retry(
+        total=DELIVERY_RETRIES,
+        backoff_factor=DELIVERY_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['POST'])
+    )
+    adapter = HTTPAdapter(pool_maxsize=DELIVERY_CONCURRENCY, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Content-Type'] = 'application/json'
+    return session
+
+@lru_cache(maxsize=None)
+def get_delivery_pool():
+    return ThreadPoolExecutor(max_workers=DELIVERY_CONCURRENCY, thread_name_prefix='delivery')
+
+def send_layout(payload, url=None, session=None):
+    # POSTs one payload and returns the decoded response; raises on failure.
+    # Any status that passes raise_for_status() counts as delivered, so a body
+    # that is not JSON must not make the outbox post the layout again.
+    url = url or DELIVERY_URL
+    session = session or get_delivery_session()
+    response = session.post(url, data=json.dumps(payload), timeout=(DELIVERY_CONNECT_TIMEOUT, DELIVERY_READ_TIMEOUT))
+    response.raise_for_status()  # Check for HTTP errors
+    print(f"POST {url} -> {response.status_code}")
+    if not response.content:
+        return {}
     try:
-        get_response = requests.get(url)
-        get_response.raise_for_status()  # Check for HTTP errors
-        print('GET response:', json.dumps(get_response.json(), indent=4))
-    except requests.exceptions.RequestException as e:
-        print('Error:', e) 
+        return response.json()
+    except ValueError:
+        print(f"POST {url} returned a non-JSON body, treating it as delivered")
+        return {"status_code": response.status_code, "text": response.text}
+
+def deliver(payload, url=None, session=None):
+    # Like send_layout, but returns None if delivery failed
+    try:
+        return send_layout(payload, url, session)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print('Error:', e)
+        return None
+
+# Function to post data
+def post_data(data_array, url=None, session=None, batch=None):
+    batch = DELIVERY_BATCH if batch is None else batch
+    if batch:
+        return [deliver(list(data_array), url, session)]
+
+    # Layouts are independent, so they are sent concurrently over the pooled session
+    futures = [get_delivery_pool().submit(deliver, data, url, session) for data in data_array]
+    return [future.result() for future in futures]
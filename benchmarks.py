@@ -0,0 +1,298 @@
+"""Micro-benchmarks for the ad template renderer.
+
+Run from the directory that contains the ``services`` package, e.g.
+
+    python benchmarks.py gradient
+
+Each benchmark compares the current implementation in services.model_1 with
+the original one it replaced and prints timings plus an output difference.
+"""
+import io
+import random
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+from services import model_1
+
+
+def _time(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+# Original per-pixel implementation, kept here as the reference
+def legacy_generate_gradient_color(color1, color2, width, height, direction='left_to_right'):
+    base = Image.new('RGB', (width, height), color1)
+    mask = Image.new('L', (width, height))
+    top = Image.new('RGB', (width, height), color2)
+
+    mask_data = []
+
+    if direction == 'left_to_right':
+        mask_data = [int(255 * (x / width)) for y in range(height) for x in range(width)]
+    elif direction == 'top_to_bottom':
+        mask_data = [int(255 * (y / height)) for y in range(height) for x in range(width)]
+    elif direction == 'right_to_left':
+        mask_data = [int(255 * ((width - x) / width)) for y in range(height) for x in range(width)]
+    elif direction == 'bottom_to_top':
+        mask_data = [int(255 * ((height - y) / height)) for y in range(height) for x in range(width)]
+    elif direction == 'diagonal_tl_br':
+        mask_data = [int(255 * ((x + y) / (width + height))) for y in range(height) for x in range(width)]
+    elif direction == 'diagonal_bl_tr':
+        mask_data = [int(255 * ((x + (height - y)) / (width + height))) for y in range(height) for x in range(width)]
+
+    mask.putdata(mask_data)
+    base.paste(top, (0, 0), mask)
+
+    return base.filter(ImageFilter.SMOOTH)
+
+
+def benchmark_gradient(width=1080, height=1080, repeat=3, color1='#d01c24', color2='#32ea4a'):
+    print(f"Gradient {width}x{height}, best of {repeat}")
+    print(f"{'direction':<16}{'legacy ms':>12}{'numpy ms':>12}{'speedup':>10}{'max diff':>10}")
+    for direction in model_1.GRADIENT_DIRECTIONS:
+        legacy_time, legacy = _time(lambda: legacy_generate_gradient_color(color1, color2, width, height, direction), repeat)
+        new_time, new = _time(lambda: model_1.generate_gradient_color(color1, color2, width, height, direction), repeat)
+        diff = np.abs(np.asarray(legacy, dtype=np.int16) - np.asarray(new, dtype=np.int16)).max()
+        print(f"{direction:<16}{legacy_time * 1000:>12.1f}{new_time * 1000:>12.1f}{legacy_time / new_time:>9.0f}x{diff:>10}")
+
+    for angle in (30, 135):
+        new_time, _ = _time(lambda: model_1.generate_gradient_color(color1, color2, width, height, angle), repeat)
+        print(f"{f'angle {angle}':<16}{'-':>12}{new_time * 1000:>12.1f}")
+    stops_time, _ = _time(lambda: model_1.generate_multi_stop_gradient([color1, '#ffffff', color2], width, height, 'diagonal_tl_br'), repeat)
+    print(f"{'3-stop diagonal':<16}{'-':>12}{stops_time * 1000:>12.1f}")
+
+
+# Original linear scan, one truetype() load and textbbox() per size step
+def legacy_adjust_font_size_based_on_space(draw, text, font_path, max_width, max_height, max_font_size=100, additional_size=0):
+    min_font_size = 28
+    font_size = min_font_size + additional_size
+
+    while font_size <= max_font_size + additional_size:
+        font = ImageFont.truetype(font_path, font_size)
+        text_bbox = draw.textbbox((0, 0), text, font=font)
+        text_width, text_height = text_bbox[2] - text_bbox[0], text_bbox[3] - text_bbox[1]
+        if text_width <= max_width and text_height <= max_height:
+            font_size += 1
+        else:
+            break
+
+    return ImageFont.truetype(font_path, font_size - 1 if font_size > min_font_size else font_size), font_size - 1 if font_size > min_font_size else font_size
+
+
+HEADING_CORPUS = [
+    "Sale",
+    "Big Sale",
+    "Fresh Coffee Daily",
+    "Big Summer Sale Today",
+    "Grand\nOpening",
+    "Limited Edition\nSneakers Drop",
+    "Unbelievable Extraordinary\nDiscounts Everywhere",
+    "WWWW MMMM",
+    "iiii llll",
+    "Buy 1 Get 1 Free",
+    "50% Off Everything",
+    "Supercalifragilisticexpialidocious Deals",
+]
+
+# (max_width, max_height, max_font_size, additional_size) boxes the layouts use
+FONT_FIT_BOXES = [
+    (648, 216, 150, 0),
+    (540, 162, 100, 0),
+    (216, 108, 100, 0),
+    (648, 216, 150, 10),
+    (100, 20, 100, 0),
+]
+
+
+def benchmark_font_fit(font_path=model_1.FONT_PATH_HEADING, repeat=3):
+    draw = ImageDraw.Draw(Image.new('RGBA', (1080, 1080)))
+    mismatches = 0
+    legacy_total = new_total = 0.0
+    for max_width, max_height, max_font_size, additional_size in FONT_FIT_BOXES:
+        for text in HEADING_CORPUS:
+            args = (draw, text, font_path, max_width, max_height, max_font_size, additional_size)
+            legacy_time, (_, legacy_size) = _time(lambda: legacy_adjust_font_size_based_on_space(*args), repeat)
+            model_1.get_font.cache_clear()
+            new_time, (font, new_size) = _time(lambda: model_1.adjust_font_size_based_on_space(*args), 1)
+            legacy_total += legacy_time
+            new_total += new_time
+            if legacy_size != new_size or font.size != new_size:
+                mismatches += 1
+                print(f"mismatch {text!r} in {max_width}x{max_height}: legacy {legacy_size}, new {new_size}")
+    cases = len(FONT_FIT_BOXES) * len(HEADING_CORPUS)
+    print(f"Font fitting, {cases} cases, cold font cache for the new routine")
+    print(f"legacy total {legacy_total * 1000:.1f} ms, new total {new_total * 1000:.1f} ms, "
+          f"speedup {legacy_total / new_total:.0f}x, {mismatches} mismatches")
+
+
+# Original ColorThief path: PNG encode, decode again, then MMCQ in pure Python
+def legacy_get_palette(image, color_count=6, quality=10):
+    # ColorThief is only needed for this comparison, not by the renderer
+    from colorthief import ColorThief
+
+    with io.BytesIO() as output:
+        image.save(output, format="PNG")
+        output.seek(0)
+        color_thief = ColorThief(output)
+        palette = color_thief.get_palette(color_count=color_count, quality=quality)
+        return ['#{:02x}{:02x}{:02x}'.format(color[0], color[1], color[2]) for color in palette]
+
+
+def _palette_sample_images():
+    logo = Image.new('RGBA', (300, 200), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(logo)
+    draw.ellipse((10, 10, 290, 190), fill=(200, 30, 30, 255))
+    draw.rectangle((60, 60, 160, 120), fill=(20, 200, 40, 255))
+    draw.text((170, 80), "LOGO", fill=(20, 20, 120, 255))
+    canvas = model_1.generate_multi_stop_gradient(['#d01c24', '#ffd700', '#32ea4a'], 1080, 1080, 'diagonal_tl_br').convert('RGBA')
+    noise = np.random.default_rng(0).integers(0, 256, (800, 1200, 3), dtype=np.uint8)
+    return [
+        ('logo 300x200, quality 10', logo, 6, 10),
+        ('canvas 1080x1080, quality 1', canvas, 5, 1),
+        ('noise photo 1200x800, quality 10', Image.fromarray(noise).convert('RGBA'), 6, 10),
+    ]
+
+
+def benchmark_palette(repeat=3):
+    for name, image, color_count, quality in _palette_sample_images():
+        legacy_time, legacy = _time(lambda: legacy_get_palette(image, color_count, quality), repeat)
+        new_time, new = _time(lambda: model_1.extract_palette(image, color_count), repeat)
+        print(f"{name}: ColorThief {legacy_time * 1000:.1f} ms, numpy {new_time * 1000:.1f} ms, speedup {legacy_time / new_time:.0f}x")
+        print(f"    ColorThief {legacy}")
+        print(f"    numpy      {new}")
+
+
+# Original CTA button: drawn 8x larger in each dimension, then LANCZOS-downscaled
+def legacy_cta_button(size, cta_shape, background_color):
+    width, height = size
+    high_res_button = Image.new('RGBA', (width * 8, height * 8), (0, 0, 0, 0))
+    high_res_draw = ImageDraw.Draw(high_res_button)
+    if cta_shape == "rounded":
+        high_res_draw.rounded_rectangle([(0, 0), (width * 8, height * 8)], radius=15 * 8, fill=background_color)
+    else:
+        high_res_draw.rectangle([(0, 0), (width * 8, height * 8)], fill=background_color)
+    return high_res_button.resize((width, height), Image.LANCZOS)
+
+
+CTA_SIZES = [(255, 97), (195, 97), (320, 110), (388, 156)]
+
+
+def benchmark_cta(repeat=5, color=(124, 128, 204, 255)):
+    print(f"CTA buttons, best of {repeat}; new timings are cold (cache cleared) and warm")
+    print(f"{'shape':<10}{'size':>10}{'legacy ms':>11}{'cold ms':>9}{'warm ms':>9}{'max diff':>10}{'mean diff':>11}")
+    backdrop = Image.new('RGBA', (400, 160), (20, 200, 40, 255))
+    for shape in ("rounded", "rectangle"):
+        radius = model_1.CTA_CORNER_RADIUS if shape == "rounded" else 0
+        for size in CTA_SIZES:
+            legacy_time, legacy = _time(lambda: legacy_cta_button(size, shape, color), repeat)
+
+            def cold():
+                model_1.rounded_rectangle_mask.cache_clear()
+                model_1.get_cta_button.cache_clear()
+                return model_1.get_cta_button(size, radius, color)
+            cold_time, new = _time(cold, repeat)
+            warm_time, _ = _time(lambda: model_1.get_cta_button(size, radius, color), repeat)
+
+            # Compare the buttons as they end up on a canvas
+            legacy_canvas, new_canvas = backdrop.copy(), backdrop.copy()
+            legacy_canvas.paste(legacy, (0, 0), legacy)
+            new_canvas.paste(new, (0, 0), new)
+            diff = np.abs(np.asarray(legacy_canvas, dtype=np.int16) - np.asarray(new_canvas, dtype=np.int16))
+            print(f"{shape:<10}{f'{size[0]}x{size[1]}':>10}{legacy_time * 1000:>11.2f}{cold_time * 1000:>9.2f}"
+                  f"{warm_time * 1000:>9.3f}{diff.max():>10}{diff.mean():>11.4f}")
+
+
+# Original sampler: one getpixel() call per pixel of each window
+def legacy_sample_background_color(image, positions, area_size=10):
+    colors = []
+    for pos in positions:
+        x, y = pos
+        for i in range(-area_size // 2, area_size // 2):
+            for j in range(-area_size // 2, area_size // 2):
+                try:
+                    colors.append(image.getpixel((x + i, y + j)))
+                except IndexError:
+                    continue
+    return tuple(sum(c) // len(c) for c in zip(*colors))
+
+
+def benchmark_sample(repeat=5):
+    canvas = model_1.generate_multi_stop_gradient(['#d01c24', '#ffd700', '#32ea4a'], 1080, 1080, 'diagonal_tl_br').convert('RGBA')
+    positions = [(378, 871), (432, 453), (324, 270), (216, 108), (1075, 1075)]
+    print(f"Background sampling at {len(positions)} positions, best of {repeat}")
+    print(f"{'window':>8}{'legacy ms':>12}{'numpy ms':>12}{'speedup':>10}  same")
+    for area_size in (10, 40, 100):
+        legacy_time, legacy = _time(lambda: [legacy_sample_background_color(canvas, [p], area_size) for p in positions], repeat)
+        new_time, new = _time(lambda: [model_1.sample_background_color(canvas, [p], area_size) for p in positions], repeat)
+        print(f"{area_size:>8}{legacy_time * 1000:>12.2f}{new_time * 1000:>12.2f}{legacy_time / new_time:>9.0f}x  {legacy == new}")
+    regions = [(x - 50, y - 50, x + 50, y + 50) for x, y in positions]
+    batch_time, _ = _time(lambda: model_1.sample_region_colors(canvas, regions), repeat)
+    print(f"sample_region_colors, {len(regions)} regions of 100x100: {batch_time * 1000:.2f} ms")
+
+
+def benchmark_few_colors(repeat=3):
+    # Regression check: logos with one or two colors have fewer distinct color
+    # pairs than there are layouts, which used to make the choice loop spin forever
+    plans = model_1.get_layout_plans()
+    solid = Image.new('RGBA', (300, 200), (200, 30, 30, 255))
+    wordmark = Image.new('RGBA', (300, 200), (0, 0, 0, 0))
+    ImageDraw.Draw(wordmark).rectangle((20, 80, 280, 120), fill=(0, 0, 0, 255))
+    two_color = Image.new('RGBA', (300, 200), (200, 30, 30, 255))
+    ImageDraw.Draw(two_color).rectangle((0, 0, 150, 200), fill=(20, 40, 200, 255))
+    for name, logo in (('solid red', solid), ('black wordmark', wordmark), ('two colors', two_color)):
+        palette, hex_colors = model_1.get_logo_colors(logo, name)
+        elapsed, choices = _time(lambda: model_1.choose_layout_styles(plans, hex_colors, random.Random(0)), repeat)
+        assert len(choices) == len(plans)
+        pairs = [tuple(colors) for colors, _, _ in choices]
+        print(f"{name}: {len(hex_colors)} candidate colors, {len(set(pairs))} distinct pairs for {len(plans)} layouts in {elapsed * 1000:.2f} ms")
+
+
+def _png_bytes(image):
+    with io.BytesIO() as output:
+        image.save(output, format='PNG')
+        return output.getvalue()
+
+
+def benchmark_preview(repeat=3):
+    # The copy changes on every run, as it does while the user types, so the
+    # text caches only help between the layouts of one request
+    logo = _png_bytes(_palette_sample_images()[0][1])
+    product = _png_bytes(model_1.generate_multi_stop_gradient(['#1c24d0', '#32ea4a'], 800, 900, 'top_to_bottom'))
+    layout_count = len(model_1.get_layout_plans())
+    runs = iter(range(1000))
+    print(f"generate_ad_preview, {layout_count} layouts, best of {repeat}")
+    print(f"{'size':>6}{'format':>8}{'ms/layout':>12}{'KB/layout':>12}")
+    for size in (1080, 540, 270):
+        for image_format in ('JPEG', 'WEBP'):
+            elapsed, previews = _time(lambda: model_1.generate_ad_preview(
+                f"Big Summer Sale {next(runs)}", "Get the best deals on all products this summer", "Shop Now", "+1 555 0100",
+                logo, product, size=size, image_format=image_format, seed=1), repeat)
+            kilobytes = sum(len(preview['image']) for preview in previews) / 1024 / len(previews)
+            print(f"{size:>6}{image_format:>8}{elapsed * 1000 / len(previews):>12.1f}{kilobytes:>12.1f}")
+
+
+BENCHMARKS = {
+    'gradient': benchmark_gradient,
+    'font_fit': benchmark_font_fit,
+    'palette': benchmark_palette,
+    'cta': benchmark_cta,
+    'sample': benchmark_sample,
+    'few_colors': benchmark_few_colors,
+    'preview': benchmark_preview,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+        print()
@@ -0,0 +1,158 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+
+# Jobs claimed by a worker that has not finished them within the lease (for
+# example because the process died) are handed out again
+JOB_LEASE_SECONDS = 600
+JOB_POLL_SECONDS = 1.0
+# A job whose lease ran out this many times (for example because it keeps
+# killing its worker) is failed instead of being handed out again
+JOB_MAX_ATTEMPTS = 3
+
+class JobQueue:
+    # Persistent render job queue in a local SQLite file, shared by the API and
+    # any number of worker threads or processes on the same machine
+    def __init__(self, path, lease_seconds=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.new_job = threading.Event()
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    request TEXT NOT NULL,
+                    logo BLOB,
+                    product BLOB,
+                    result TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    lease_expires_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def enqueue(self, request, logo_bytes, product_bytes):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, request, logo, product, created_at, updated_at) VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+                (job_id, json.dumps(request), logo_bytes, product_bytes, now, now)
+            )
+        self.new_job.set()
+        return job_id
+
+    def claim(self):
+        # Atomically take the oldest queued job, or a running one whose lease ran out
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, logo = NULL, product = NULL, updated_at = ?, lease_expires_at = NULL "
+                "WHERE status = 'running' AND lease_expires_at < ? AND attempts >= ?",
+                (f"Gave up after {self.max_attempts} attempts; the worker stopped before finishing", now, now, self.max_attempts)
+            )
+            row = conn.execute(
+                "SELECT id, request, logo, product FROM jobs "
+                "WHERE status = 'queued' OR (status = 'running' AND lease_expires_at < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                conn.commit()
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ?, lease_expires_at = ? WHERE id = ?",
+                (now, now + self.lease_seconds, row[0])
+            )
+            conn.commit()
+        return {"id": row[0], "request": json.loads(row[1]), "logo_bytes": row[2], "product_bytes": row[3]}
+
+    def complete(self, job_id, result):
+        # The uploaded images are no longer needed once the job is done
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, logo = NULL, product = NULL, updated_at = ?, lease_expires_at = NULL WHERE id = ?",
+                (json.dumps(result), time.time(), job_id)
+            )
+
+    def fail(self, job_id, error):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, logo = NULL, product = NULL, updated_at = ?, lease_expires_at = NULL WHERE id = ?",
+                (error, time.time(), job_id)
+            )
+
+    def get(self, job_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT id, status, result, error, attempts, created_at, updated_at FROM jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        job = {"job_id": row[0], "status": row[1], "attempts": row[4], "created_at": row[5], "updated_at": row[6]}
+        if row[2] is not None:
+            job["layouts_info"] = json.loads(row[2])
+        if row[3] is not None:
+            job["error"] = row[3]
+        return job
+
+    def depth(self):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+
+def run_worker(queue, handler, stop_event, poll_seconds=JOB_POLL_SECONDS):
+    # handler(request, logo_bytes, product_bytes) returns the job result
+    while not stop_event.is_set():
+        try:
+            job = queue.claim()
+        except sqlite3.Error as e:
+            # For example "database is locked"; the worker keeps polling
+            print(f"Claiming a job failed: {e}")
+            stop_event.wait(poll_seconds)
+            continue
+        if job is None:
+            # Woken early when this process enqueues; other processes are seen on the next poll
+            queue.new_job.wait(poll_seconds)
+            queue.new_job.clear()
+            continue
+
+        print(f"Processing job {job['id']}")
+        error = None
+        try:
+            result = handler(job["request"], job["logo_bytes"], job["product_bytes"])
+        except Exception as e:
+            print(f"Job {job['id']} failed: {e}")
+            error = str(e)
+
+        try:
+            if error is None:
+                queue.complete(job["id"], result)
+                print(f"Job {job['id']} done")
+            else:
+                queue.fail(job["id"], error)
+        except sqlite3.Error as e:
+            # The job stays running and is handed out again once its lease runs out
+            print(f"Recording the outcome of job {job['id']} failed: {e}")
+
+def start_workers(queue, handler, count, poll_seconds=JOB_POLL_SECONDS):
+    stop_event = threading.Event()
+    threads = []
+    for n in range(count):
+        thread = threading.Thread(target=run_worker, args=(queue, handler, stop_event, poll_seconds), name=f"job-worker-{n + 1}", daemon=True)
+        thread.start()
+        threads.append(thread)
+    return stop_event, threads
@@ -1,10 +1,33 @@
 from fastapi import FastAPI, UploadFile, File
+from fastapi.responses import JSONResponse
+from concurrent.futures import ThreadPoolExecutor
 from services.model_1 import generate_ad_template
+import asyncio
+import os
 import requests
 import json
 
 app = FastAPI()
 
+# Renders run on a bounded executor so the event loop stays free for other
+# requests. At most RENDER_CONCURRENCY renders run at once and RENDER_QUEUE_SIZE
+# more may wait; beyond that the endpoint answers 503 straight away.
+RENDER_CONCURRENCY = int(os.environ.get('RENDER_CONCURRENCY', '2'))
+RENDER_QUEUE_SIZE = int(os.environ.get('RENDER_QUEUE_SIZE', '8'))
+RETRY_AFTER_SECONDS = int(os.environ.get('RETRY_AFTER_SECONDS', '10'))
+
+render_executor = ThreadPoolExecutor(max_workers=RENDER_CONCURRENCY, thread_name_prefix='render')
+pending_renders = 0  # Only touched from the event loop
+
+@app.on_event("shutdown")
+def stop_render_executor():
+    render_executor.shutdown(wait=True)
+
+def generate_and_post(heading, desc, cta, contact, logo_bytes, product_bytes):
+    layouts_info = generate_ad_template(heading, desc, cta, contact, logo_bytes, product_bytes)
+    post_data(layouts_info)  # Send the generated layout info to the API
+    return layouts_info
+
 @app.post("/generate_ad_template/")
 async def generate_ad_template_endpoint(
     heading: str,
@@ -14,12 +37,25 @@ async def generate_ad_template_endpoint(
     logo_path: UploadFile = File(...),
     product_path: UploadFile = File(...)
 ):
-    logo_bytes = await logo_path.read()
-    product_bytes = await product_path.read()
-    layouts_info = generate_ad_template(heading, desc, cta, contact, logo_bytes, product_bytes)
-    
-    post_data(layouts_info)  # Send the generated layout info to the API
-    
+    global pending_renders
+
+    if pending_renders >= RENDER_CONCURRENCY + RENDER_QUEUE_SIZE:
+        return JSONResponse(
+            status_code=503,
+            content={"error": "Server is busy rendering other templates, please retry later"},
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+        )
+
+    pending_renders += 1
+    try:
+        logo_bytes = await logo_path.read()
+        product_bytes = await product_path.read()
+        # Render and post off the event loop so other requests are not blocked
+        loop = asyncio.get_running_loop()
+        layouts_info = await loop.run_in_executor(render_executor, generate_and_post, heading, desc, cta, contact, logo_bytes, product_bytes)
+    finally:
+        pending_renders -= 1
+
     return {
         "message": "Ad template generated and posted successfully",
         "layouts_info": layouts_info
@@ -1,16 +1,207 @@
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, Request
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from typing import Optional
-from services.model_1 import generate_ad_template, post_data
+from typing import List, Optional, Union
+from concurrent.futures import ThreadPoolExecutor
+from services.model_1 import generate_ad_template, generate_ad_preview, send_layout, preload_fonts, get_layout_plans, select_layout_plans, select_request_plans
+from services.job_queue import JobQueue, start_workers
+from services.outbox import Outbox, start_sender
+import asyncio
+import base64
+import hashlib
 import json
+import os
+import sys
 
 app = FastAPI()
 
+# Renders run on a bounded executor so the event loop stays free for other
+# requests. At most RENDER_CONCURRENCY renders run at once and RENDER_QUEUE_SIZE
+# more may wait; beyond that the endpoint answers 503 straight away.
+RENDER_CONCURRENCY = int(os.environ.get('RENDER_CONCURRENCY', '2'))
+RENDER_QUEUE_SIZE = int(os.environ.get('RENDER_QUEUE_SIZE', '8'))
+RETRY_AFTER_SECONDS = int(os.environ.get('RETRY_AFTER_SECONDS', '10'))
+
+render_executor = ThreadPoolExecutor(max_workers=RENDER_CONCURRENCY, thread_name_prefix='render')
+pending_renders = 0  # Only touched from the event loop
+
+# Previews are small and quick, so they get their own executor rather than
+# waiting behind full renders. They are admitted the same way: at most
+# PREVIEW_QUEUE_SIZE wait, and per-keystroke bursts beyond that get a 503.
+PREVIEW_CONCURRENCY = int(os.environ.get('PREVIEW_CONCURRENCY', '2'))
+PREVIEW_QUEUE_SIZE = int(os.environ.get('PREVIEW_QUEUE_SIZE', '4'))
+
+preview_executor = ThreadPoolExecutor(max_workers=PREVIEW_CONCURRENCY, thread_name_prefix='preview')
+pending_previews = 0  # Only touched from the event loop
+
+# Job based API: requests are stored in a local SQLite queue and rendered by
+# JOB_WORKERS background threads. Set JOB_WORKERS=0 to only enqueue here and run
+# `python main_1_updated_2.py worker` processes separately.
+JOBS_DB_PATH = os.environ.get('JOBS_DB_PATH', 'jobs.sqlite3')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '1'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+
+job_queue = JobQueue(JOBS_DB_PATH, max_attempts=JOB_MAX_ATTEMPTS)
+job_workers_stop = None
+
+# Downstream delivery goes through a durable outbox drained by a background
+# sender, so the downstream API's latency and outages never reach our clients
+OUTBOX_DB_PATH = os.environ.get('OUTBOX_DB_PATH', 'outbox.sqlite3')
+OUTBOX_CONCURRENCY = int(os.environ.get('OUTBOX_CONCURRENCY', '4'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '8'))
+
+outbox = Outbox(OUTBOX_DB_PATH, max_attempts=OUTBOX_MAX_ATTEMPTS)
+outbox_sender_stop = None
+
+# Uploads are read in chunks and hashed on the way in. A request whose declared
+# size is already too large is turned away before its body is parsed.
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', str(20 * 1024 * 1024)))
+MAX_REQUEST_BYTES = 2 * MAX_UPLOAD_BYTES + 64 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+class UploadTooLarge(Exception):
+    pass
+
 class AdTemplateRequest(BaseModel):
     heading: str
     desc: str
     cta: str
     contact: str
+    # Optional: the same seed and inputs always render the same templates
+    seed: Optional[Union[int, str]] = None
+    # Optional: render only these layouts, and/or at most this many of them
+    layout_ids: Optional[List[str]] = None
+    layout_count: Optional[int] = None
+    # Return the first layout as soon as it is ready and render the rest as a job
+    preview_first: bool = False
+    # Set by preview_first on its parts: colors and shapes are picked over these
+    # layouts, so the parts match a single render of the whole selection
+    style_layout_ids: Optional[List[str]] = None
+
+class AdPreviewRequest(AdTemplateRequest):
+    # Optional: preview width in pixels and JPEG or WEBP, server defaults otherwise
+    preview_size: Optional[int] = None
+    preview_format: Optional[str] = None
+
+@app.on_event("startup")
+def load_fonts():
+    # Open the font files once per worker process, before the first request
+    preload_fonts()
+
+@app.on_event("startup")
+def load_layouts():
+    # A broken layout spec stops the app here instead of failing requests
+    get_layout_plans()
+
+@app.on_event("startup")
+def start_job_workers():
+    global job_workers_stop
+    if JOB_WORKERS > 0:
+        job_workers_stop, _ = start_workers(job_queue, process_job, JOB_WORKERS)
+
+@app.on_event("startup")
+def start_outbox_sender():
+    global outbox_sender_stop
+    outbox_sender_stop, _ = start_sender(outbox, send_layout, OUTBOX_CONCURRENCY)
+
+@app.on_event("shutdown")
+def stop_render_executor():
+    if job_workers_stop is not None:
+        job_workers_stop.set()
+    if outbox_sender_stop is not None:
+        outbox_sender_stop.set()
+    render_executor.shutdown(wait=True)
+    preview_executor.shutdown(wait=True)
+
+@app.middleware("http")
+async def reject_oversized_requests(request: Request, call_next):
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > MAX_REQUEST_BYTES:
+        return JSONResponse(status_code=413, content={"error": f"Request body is larger than {MAX_REQUEST_BYTES} bytes"})
+    return await call_next(request)
+
+async def read_upload(upload, max_bytes=MAX_UPLOAD_BYTES):
+    # Returns the upload's bytes and their SHA-256. The bytes object is passed
+    # as is to decoding and the S3 upload, which wrap it without copying.
+    if upload.size is not None and upload.size > max_bytes:
+        raise UploadTooLarge(f"{upload.filename} is larger than {max_bytes} bytes")
+
+    if upload.size is not None:
+        # The spooled size is known, so read straight into one buffer of that
+        # size; joining chunks would hold two copies of the upload at the peak.
+        # A bytes object, unlike a bytearray, is shared by io.BytesIO later on.
+        data = await upload.read()
+        return data, hashlib.sha256(data).hexdigest()
+
+    # Unknown size: read in chunks so the limit is enforced while reading
+    digest = hashlib.sha256()
+    chunks = []
+    total = 0
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > max_bytes:
+            raise UploadTooLarge(f"{upload.filename} is larger than {max_bytes} bytes")
+        digest.update(chunk)
+        chunks.append(chunk)
+    return b"".join(chunks), digest.hexdigest()
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "pending_renders": pending_renders}
+
+def generate_and_post(ad_request, logo_bytes, product_bytes, logo_digest=None, product_digest=None):
+    # Generate the ad template
+    layouts_info = generate_ad_template(
+        ad_request.heading,
+        ad_request.desc,
+        ad_request.cta,
+        ad_request.contact,
+        logo_bytes,
+        product_bytes,
+        seed=ad_request.seed,
+        logo_digest=logo_digest,
+        product_digest=product_digest,
+        layout_ids=ad_request.layout_ids,
+        layout_count=ad_request.layout_count,
+        style_layout_ids=ad_request.style_layout_ids
+    )
+
+    # Queue the data for delivery; the outbox sender posts it in the background.
+    # Cached results come back unchanged for retried requests, so each layout is
+    # keyed by its content and only queued once.
+    outbox.add(layouts_info, [hashlib.sha256(json.dumps(layout, sort_keys=True).encode()).hexdigest() for layout in layouts_info])
+
+    return layouts_info
+
+def process_job(request_dict, logo_bytes, product_bytes):
+    return generate_and_post(AdTemplateRequest(**request_dict), logo_bytes, product_bytes)
+
+@app.get("/outbox/metrics")
+async def outbox_metrics():
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, outbox.metrics)
+
+async def generate_preview_first(ad_request, logo_bytes, product_bytes, logo_digest, product_digest):
+    # Renders the first selected layout now and queues the others as a job,
+    # whose progress the client follows at /jobs/{job_id}
+    layout_ids = [plan.id for plan in select_layout_plans(ad_request.layout_ids, ad_request.layout_count)]
+    request_dict = dict(ad_request.dict(), layout_count=None, preview_first=False, style_layout_ids=layout_ids)
+
+    loop = asyncio.get_running_loop()
+    preview_request = AdTemplateRequest(**dict(request_dict, layout_ids=layout_ids[:1]))
+    layouts_info = await loop.run_in_executor(render_executor, generate_and_post, preview_request, logo_bytes, product_bytes, logo_digest, product_digest)
+
+    response = {
+        "message": "Preview generated successfully, delivery queued",
+        "layouts_info": layouts_info
+    }
+    if len(layout_ids) > 1:
+        remaining = dict(request_dict, layout_ids=layout_ids[1:])
+        response["remaining_job_id"] = await loop.run_in_executor(None, job_queue.enqueue, remaining, logo_bytes, product_bytes)
+    return response
 
 @app.post("/generate_ad_template/")
 async def generate_ad_template_endpoint(
@@ -18,32 +209,135 @@ async def generate_ad_template_endpoint(
     logo_path: UploadFile = File(...),
     product_path: UploadFile = File(...)
 ):
+    global pending_renders
+
+    if pending_renders >= RENDER_CONCURRENCY + RENDER_QUEUE_SIZE:
+        return JSONResponse(
+            status_code=503,
+            content={"error": "Server is busy rendering other templates, please retry later"},
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+        )
+
+    pending_renders += 1
     try:
         # Parse the JSON string into a dictionary
         request_dict = json.loads(request)
         ad_request = AdTemplateRequest(**request_dict)
         
-        logo_bytes = await logo_path.read()
-        product_bytes = await product_path.read()
+        logo_bytes, logo_digest = await read_upload(logo_path)
+        product_bytes, product_digest = await read_upload(product_path)
         
-        # Generate the ad template
-        layouts_info = generate_ad_template(
-            ad_request.heading,
-            ad_request.desc,
-            ad_request.cta,
-            ad_request.contact,
-            logo_bytes,
-            product_bytes
-        )
-        
-        # Post the data
-        post_data(layouts_info)
+        loop = asyncio.get_running_loop()
+        if ad_request.preview_first:
+            return await generate_preview_first(ad_request, logo_bytes, product_bytes, logo_digest, product_digest)
+
+        layouts_info = await loop.run_in_executor(render_executor, generate_and_post, ad_request, logo_bytes, product_bytes, logo_digest, product_digest)
         
         return {
-            "message": "Ad template generated and posted successfully",
+            "message": "Ad template generated successfully, delivery queued",
             "layouts_info": layouts_info
         }
     except json.JSONDecodeError:
         return {"error": "Invalid JSON in request field"}
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={"error": str(e)})
     except Exception as e:
         return {"error": str(e)}
+    finally:
+        pending_renders -= 1
+
+@app.post("/preview_ad_template/")
+async def preview_ad_template_endpoint(
+    request: str = Form(...),
+    logo_path: UploadFile = File(...),
+    product_path: UploadFile = File(...)
+):
+    # Low resolution previews for the editor: nothing is uploaded, cached or
+    # delivered, and the images come back inline as base64
+    global pending_previews
+
+    if pending_previews >= PREVIEW_CONCURRENCY + PREVIEW_QUEUE_SIZE:
+        return JSONResponse(
+            status_code=503,
+            content={"error": "Server is busy rendering other previews, please retry later"},
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+        )
+
+    pending_previews += 1
+    try:
+        ad_request = AdPreviewRequest(**json.loads(request))
+        logo_bytes, logo_digest = await read_upload(logo_path)
+        product_bytes, product_digest = await read_upload(product_path)
+
+        loop = asyncio.get_running_loop()
+        previews = await loop.run_in_executor(
+            preview_executor,
+            lambda: generate_ad_preview(
+                ad_request.heading, ad_request.desc, ad_request.cta, ad_request.contact,
+                logo_bytes, product_bytes,
+                size=ad_request.preview_size,
+                image_format=ad_request.preview_format,
+                seed=ad_request.seed,
+                layout_ids=ad_request.layout_ids,
+                layout_count=ad_request.layout_count,
+                logo_digest=logo_digest,
+                product_digest=product_digest
+            )
+        )
+    except json.JSONDecodeError:
+        return JSONResponse(status_code=400, content={"error": "Invalid JSON in request field"})
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={"error": str(e)})
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    finally:
+        pending_previews -= 1
+
+    for preview in previews:
+        preview["image"] = base64.b64encode(preview["image"]).decode('ascii')
+    return {"previews": previews}
+
+@app.post("/jobs/generate_ad_template/", status_code=202)
+async def enqueue_ad_template_job(
+    request: str = Form(...),
+    logo_path: UploadFile = File(...),
+    product_path: UploadFile = File(...)
+):
+    try:
+        # Validate up front so bad requests fail here rather than in a worker
+        ad_request = AdTemplateRequest(**json.loads(request))
+        select_request_plans(ad_request.layout_ids, ad_request.layout_count, ad_request.style_layout_ids)
+    except json.JSONDecodeError:
+        return JSONResponse(status_code=400, content={"error": "Invalid JSON in request field"})
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+    try:
+        logo_bytes, _ = await read_upload(logo_path)
+        product_bytes, _ = await read_upload(product_path)
+    except UploadTooLarge as e:
+        return JSONResponse(status_code=413, content={"error": str(e)})
+
+    loop = asyncio.get_running_loop()
+    job_id = await loop.run_in_executor(None, job_queue.enqueue, ad_request.dict(), logo_bytes, product_bytes)
+
+    return {"job_id": job_id, "status": "queued"}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    loop = asyncio.get_running_loop()
+    job = await loop.run_in_executor(None, job_queue.get, job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Job not found"})
+    return job
+
+if __name__ == "__main__" and sys.argv[1:] == ["worker"]:
+    # Standalone render worker: `python main_1_updated_2.py worker`
+    preload_fonts()
+    get_layout_plans()
+    stop_event, threads = start_workers(job_queue, process_job, max(JOB_WORKERS, 1))
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        stop_event.set()
@@ -0,0 +1,171 @@
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+OUTBOX_CONCURRENCY = 4
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_SECONDS = 2.0
+OUTBOX_MAX_BACKOFF_SECONDS = 300.0
+# Messages claimed by a sender that died are retried once the lease runs out
+OUTBOX_LEASE_SECONDS = 120
+OUTBOX_POLL_SECONDS = 1.0
+# Delivered messages are kept this long for the lag metrics, then purged
+OUTBOX_RETENTION_SECONDS = 24 * 3600
+
+class Outbox:
+    # Durable queue of downstream deliveries in a local SQLite file. Messages
+    # move pending -> sending -> delivered, or to dead after too many failures.
+    def __init__(self, path, max_attempts=OUTBOX_MAX_ATTEMPTS, backoff_seconds=OUTBOX_BACKOFF_SECONDS, lease_seconds=OUTBOX_LEASE_SECONDS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.lease_seconds = lease_seconds
+        self.new_message = threading.Event()
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    next_attempt_at REAL NOT NULL,
+                    lease_expires_at REAL,
+                    delivered_at REAL,
+                    dedupe_key TEXT
+                )
+            """)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(outbox)")]
+            if "dedupe_key" not in columns:
+                conn.execute("ALTER TABLE outbox ADD COLUMN dedupe_key TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS outbox_dedupe ON outbox (dedupe_key)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def add(self, payloads, dedupe_keys=None):
+        # A payload whose dedupe key is already queued or delivered is skipped,
+        # so retried requests are not posted twice; a dead-lettered one is retried
+        now = time.time()
+        dedupe_keys = dedupe_keys or [None] * len(payloads)
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT INTO outbox (payload, status, created_at, next_attempt_at, dedupe_key) VALUES (?, 'pending', ?, ?, ?) "
+                "ON CONFLICT (dedupe_key) DO UPDATE SET status = 'pending', attempts = 0, last_error = NULL, next_attempt_at = excluded.next_attempt_at "
+                "WHERE status = 'dead'",
+                [(json.dumps(payload), now, now, dedupe_key) for payload, dedupe_key in zip(payloads, dedupe_keys)]
+            )
+        self.new_message.set()
+
+    def claim(self, limit):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, payload, attempts FROM outbox "
+                "WHERE (status = 'pending' AND next_attempt_at <= ?) OR (status = 'sending' AND lease_expires_at < ?) "
+                "ORDER BY next_attempt_at LIMIT ?",
+                (now, now, limit)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE outbox SET status = 'sending', attempts = attempts + 1, lease_expires_at = ? WHERE id = ?",
+                [(now + self.lease_seconds, row[0]) for row in rows]
+            )
+            conn.commit()
+        return [{"id": row[0], "payload": json.loads(row[1]), "attempts": row[2] + 1} for row in rows]
+
+    def mark_delivered(self, message_id):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE outbox SET status = 'delivered', delivered_at = ?, lease_expires_at = NULL WHERE id = ?",
+                (time.time(), message_id)
+            )
+
+    def mark_failed(self, message_id, attempts, error):
+        # Exponential backoff between attempts; dead-lettered after max_attempts
+        with closing(self._connect()) as conn, conn:
+            if attempts >= self.max_attempts:
+                conn.execute(
+                    "UPDATE outbox SET status = 'dead', last_error = ?, lease_expires_at = NULL WHERE id = ?",
+                    (error, message_id)
+                )
+            else:
+                delay = min(self.backoff_seconds * 2 ** (attempts - 1), OUTBOX_MAX_BACKOFF_SECONDS)
+                conn.execute(
+                    "UPDATE outbox SET status = 'pending', last_error = ?, next_attempt_at = ?, lease_expires_at = NULL WHERE id = ?",
+                    (error, time.time() + delay, message_id)
+                )
+
+    def purge_delivered(self, retention_seconds=OUTBOX_RETENTION_SECONDS):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM outbox WHERE status = 'delivered' AND delivered_at < ?", (time.time() - retention_seconds,))
+
+    def metrics(self, window_seconds=300):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+            oldest_pending = conn.execute("SELECT MIN(created_at) FROM outbox WHERE status IN ('pending', 'sending')").fetchone()[0]
+            lag = conn.execute(
+                "SELECT AVG(delivered_at - created_at), MAX(delivered_at - created_at) FROM outbox WHERE status = 'delivered' AND delivered_at >= ?",
+                (now - window_seconds,)
+            ).fetchone()
+        return {
+            "queue_depth": counts.get('pending', 0) + counts.get('sending', 0),
+            "sending": counts.get('sending', 0),
+            "dead_letters": counts.get('dead', 0),
+            "delivered": counts.get('delivered', 0),
+            "oldest_pending_age_seconds": now - oldest_pending if oldest_pending is not None else 0.0,
+            "delivery_lag_avg_seconds": lag[0],
+            "delivery_lag_max_seconds": lag[1],
+        }
+
+def run_sender(outbox, send, stop_event, concurrency=OUTBOX_CONCURRENCY, poll_seconds=OUTBOX_POLL_SECONDS):
+    # send(payload) must raise on failure. At most `concurrency` deliveries are in flight.
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='outbox-send') as pool:
+        last_purge = 0.0
+        while not stop_event.is_set():
+            try:
+                messages = outbox.claim(concurrency)
+                if not messages and time.time() - last_purge > 3600:
+                    outbox.purge_delivered()
+                    last_purge = time.time()
+            except sqlite3.Error as e:
+                # For example "database is locked"; the sender keeps polling
+                print(f"Outbox claim failed: {e}")
+                stop_event.wait(poll_seconds)
+                continue
+            if not messages:
+                outbox.new_message.wait(poll_seconds)
+                outbox.new_message.clear()
+                continue
+
+            futures = [(message, pool.submit(send, message["payload"])) for message in messages]
+            for message, future in futures:
+                error = None
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Outbox delivery {message['id']} failed (attempt {message['attempts']}): {e}")
+                    error = str(e)
+
+                try:
+                    if error is None:
+                        outbox.mark_delivered(message["id"])
+                    else:
+                        outbox.mark_failed(message["id"], message["attempts"], error)
+                except sqlite3.Error as e:
+                    # The message goes out again once its lease runs out
+                    print(f"Recording outbox delivery {message['id']} failed: {e}")
+                    stop_event.wait(poll_seconds)
+
+def start_sender(outbox, send, concurrency=OUTBOX_CONCURRENCY, poll_seconds=OUTBOX_POLL_SECONDS):
+    stop_event = threading.Event()
+    thread = threading.Thread(target=run_sender, args=(outbox, send, stop_event, concurrency, poll_seconds), name="outbox-sender", daemon=True)
+    thread.start()
+    return stop_event, thread